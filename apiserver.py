@@ -1,58 +1,571 @@
 import asyncio
+import collections
+import json
 import logging
 import os
 import socket
 import sys
 import threading
+import time
 import typing
 from os import getenv
 
 import uvicorn
 from asgiref.typing import ASGIApplication
-from fastapi import FastAPI
+from fastapi import FastAPI, Header, HTTPException, Request, Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from pydantic import BaseModel
+from pykube.exceptions import ObjectDoesNotExist
+from starlette.routing import Match
+from starlette.concurrency import run_in_threadpool
 from uvicorn.config import Config
 from uvicorn.server import Server
+from context import api
 from resources.FRPClient import FRPClient
 from resources.FRPClientEndpoint import FRPClientEndpoint, FRPClientEndpointModel
 from resources.FRPServer import FRPServer
 from resources.Namespace import Namespace
-from resources.common import Labels
+from resources.secret import Secret, secret_cache
+from index import EndpointIndex, LabelIndex
+from metrics import INDEX_SIZE, REQUEST_DURATION, RESPONSE_SIZE
+from profiling import profiled
+from informer import Event, Informer
+from snapshot import ConfigMapStore, FileStore, Snapshot, Store
+from compression import compress, negotiateEncoding
+from servicesconfig import (
+    RenderedServices,
+    SelectionKey,
+    ServicesConfigCache,
+    configVersion,
+)
 
 app = FastAPI()
-endpoints: typing.Dict[str, typing.Dict[str, FRPClientEndpointModel]] = {}
-namespaces: typing.Dict[str, Namespace] = {}
+endpoints: EndpointIndex[FRPClientEndpointModel] = EndpointIndex()
+namespaces: LabelIndex[str, Namespace] = LabelIndex()
+services = ServicesConfigCache(endpoints, namespaces)
+
+INDEX_SIZE.labels("endpoints").set_function(lambda: len(endpoints))
+INDEX_SIZE.labels("namespaces").set_function(lambda: len(namespaces))
+INDEX_SIZE.labels("rendered_services").set_function(lambda: len(services.rendered))
+
+
+def route_path(request: Request):
+    """
+    Path template of the route serving request, so metrics are not labelled
+    per object
+    """
+    for route in app.router.routes:
+        match, _ = route.matches(request.scope)
+        if match == Match.FULL:
+            return getattr(route, "path", "")
+    return "unmatched"
+
+
+@app.middleware("http")
+async def observe_requests(request: Request, call_next):
+    started = time.perf_counter()
+    response = await call_next(request)
+    route = route_path(request)
+    REQUEST_DURATION.labels(request.method, route, response.status_code).observe(
+        time.perf_counter() - started
+    )
+    size = response.headers.get("content-length")
+    if size is not None:
+        RESPONSE_SIZE.labels(route).observe(int(size))
+    return response
+
+
+# Long-poll waiters block on the event of the selection (see
+# servicesconfig.selectionKey) they rendered; a change to the endpoint/namespace
+# state sets the events of the selections it invalidated, other waiters sleep on.
+# Changes are coalesced per selection: its event is only set once no further
+# change to it arrived for CONFIG_COALESCE_SECONDS (bounded by
+# CONFIG_COALESCE_MAX_SECONDS), so a burst of endpoint updates reaches sidecars
+# as a single config generation.
+COALESCE_SECONDS = float(getenv("CONFIG_COALESCE_SECONDS", 1))
+COALESCE_MAX_SECONDS = float(getenv("CONFIG_COALESCE_MAX_SECONDS", 10))
+
+loop: typing.Optional[asyncio.AbstractEventLoop] = None
+# selection -> event its waiters block on, and how many are waiting
+events: typing.Dict[SelectionKey, asyncio.Event] = {}
+waiting: typing.Counter[SelectionKey] = collections.Counter()
+# selection -> pending wake and the start of the burst it coalesces
+flushes: typing.Dict[SelectionKey, typing.Tuple[asyncio.TimerHandle, float]] = {}
+
+
+@app.on_event("startup")
+async def bind_loop():
+    global loop
+    loop = asyncio.get_running_loop()
+
+
+def _wake_waiters(selection: SelectionKey):
+    flushes.pop(selection, None)
+    event = events.pop(selection, None)
+    if event is not None:
+        event.set()
+
+
+def _schedule_wake(selections: typing.Optional[typing.Iterable[SelectionKey]]):
+    assert loop
+    now = loop.time()
+    for selection in list(events) if selections is None else selections:
+        if selection not in events:
+            # nobody is waiting for it
+            continue
+        pending = flushes.get(selection)
+        if pending is None:
+            burstStart = now
+        else:
+            pending[0].cancel()
+            burstStart = pending[1]
+        delay = min(COALESCE_SECONDS, burstStart + COALESCE_MAX_SECONDS - now)
+        if delay <= 0:
+            _wake_waiters(selection)
+        else:
+            flushes[selection] = (
+                loop.call_later(delay, _wake_waiters, selection),
+                burstStart,
+            )
+
+
+def settling(selection: SelectionKey):
+    """
+    Whether a burst of changes to selection is still being coalesced
+    """
+    return selection in flushes
+
+
+def notify_changed(selections: typing.Optional[typing.Iterable[SelectionKey]] = None):
+    """
+    Wake long-poll requests waiting for the given selections after endpoints or
+    namespaces changed, or all of them (client selectors changed). Safe to call
+    from kopf handler threads.
+    """
+    if loop is not None:
+        loop.call_soon_threadsafe(_schedule_wake, selections)
+
+
+def store_endpoint(endpoint: FRPClientEndpointModel):
+    notify_changed(services.putEndpoint(endpoint))
+
+
+def remove_endpoint(namespace: str, name: str):
+    notify_changed(services.popEndpoint(namespace, name))
+
+
+def store_namespace(namespace: Namespace):
+    notify_changed(services.putNamespace(namespace))
+
+
+def remove_namespace(name: str):
+    notify_changed(services.popNamespace(name))
+
+
+def on_endpoint_event(event: Event):
+    obj = event["object"]
+    namespace = obj["metadata"].get("namespace")
+    if not namespace:
+        return
+    if event["type"] == "DELETED":
+        remove_endpoint(namespace, obj["metadata"]["name"])
+    else:
+        store_endpoint(FRPClientEndpointModel.parse_obj(obj))
+
+
+def on_namespace_event(event: Event):
+    obj = event["object"]
+    if event["type"] == "DELETED":
+        remove_namespace(obj["metadata"]["name"])
+    else:
+        store_namespace(Namespace.parse_obj(obj))
+
+
+def notify_frp_client_changed(namespace: str, name: str):
+    """
+    Wake the waiters of the selection a FRPClient last rendered, after its
+    selectors changed or it was deleted
+    """
+    selection = services.clients.get((namespace, name))
+    if selection is not None:
+        notify_changed([selection])
+
+
+def selectors(obj: typing.Optional[Event]):
+    spec = (obj or {}).get("spec") or {}
+    return spec.get("selector"), spec.get("namespaceSelector")
+
+
+def on_frp_client_event(event: Event):
+    metadata = event["object"]["metadata"]
+    namespace, name = metadata["namespace"], metadata["name"]
+    previous = FRPClient.cache.get(namespace, name)
+    FRPClient.cache.apply(event)
+    # most events are status and annotation patches, they change no selection
+    if event["type"] == "DELETED" or (
+        previous is not None and selectors(previous) != selectors(event["object"])
+    ):
+        notify_frp_client_changed(namespace, name)
+    if event["type"] == "DELETED":
+        services.forget(namespace, name)
+
+
+def on_frp_server_event(event: Event):
+    FRPServer.cache.apply(event)
+    secret_cache.referenceBy(FRPServer, event)
+
+
+def is_referenced_secret(obj: Event):
+    return secret_cache.isReferenced(*Informer._key(obj))
+
+
+# Outside of the operator (python apiserver.py) the state is fed by informers of
+# its own, so any number of read replicas can serve configs next to the replica
+# running kopf.
+informers = [
+    Informer(FRPClientEndpoint, on_endpoint_event),
+    Informer(Namespace, on_namespace_event),
+    Informer(FRPClient, on_frp_client_event),
+    Informer(FRPServer, on_frp_server_event),
+]
+# FRPServer configs read their secrets from the cache, only the referenced ones
+# are held, so they are listed once the FRPServers are. Secrets stay out of the snapshot, they would end up in a ConfigMap.
+secretInformer = Informer(
+    Secret, secret_cache.apply, keep=is_referenced_secret, after=informers[3]
+)
+
+
+# configs are incomplete until endpoints and namespaces were listed once
+syncInformers = informers[:2]
+RETRY_AFTER = getenv("RETRY_AFTER_SECONDS", "5")
+
+
+def synced():
+    return all(informer.synced for informer in syncInformers)
+
+
+def ensure_synced():
+    if not synced():
+        raise HTTPException(
+            503, "Initial sync in progress", headers={"Retry-After": RETRY_AFTER}
+        )
+
+
+async def prime():
+    """
+    Fill endpoints and namespaces with one list request each, for the kopf-fed
+    mode where on.resume handlers would replay them one by one
+    """
+    await asyncio.gather(*(informer.list() for informer in syncInformers))
+
+
+# SNAPSHOT_CONFIGMAP (namespace/name) survives rollouts, SNAPSHOT_PATH only on a
+# persistent volume
+SNAPSHOT_INTERVAL = float(getenv("SNAPSHOT_INTERVAL", 30))
+store: typing.Optional[Store] = None
+if getenv("SNAPSHOT_CONFIGMAP"):
+    snapshotNamespace, _, snapshotName = getenv("SNAPSHOT_CONFIGMAP", "").rpartition(
+        "/"
+    )
+    # the writer keeps its lease as long as it renews it every few intervals
+    store = ConfigMapStore(
+        api,
+        snapshotNamespace or "frp-operator",
+        snapshotName,
+        leaseSeconds=3 * SNAPSHOT_INTERVAL,
+    )
+elif getenv("SNAPSHOT_PATH"):
+    store = FileStore(getenv("SNAPSHOT_PATH", ""))
+
+snapshot: typing.Optional[Snapshot] = None
+if store is not None:
+    snapshot = Snapshot(store, informers, interval=SNAPSHOT_INTERVAL)
+
+
+async def start_informers():
+    if snapshot is not None:
+        snapshot.load()
+        snapshot.start()
+    for informer in [*informers, secretInformer]:
+        informer.start()
+
+
+async def stop_informers():
+    await asyncio.gather(
+        *(informer.stop() for informer in [*informers, secretInformer])
+    )
+    if snapshot is not None:
+        await snapshot.stop()
+
+
+def parseETags(header: typing.Optional[str]) -> typing.List[str]:
+    """
+    Versions listed in an If-None-Match header, weak validators included
+    """
+    if not header:
+        return []
+    return [tag.strip().removeprefix("W/").strip('"') for tag in header.split(",")]
+
+
+def conditional_response(
+    body: bytes,
+    version: str,
+    if_none_match: typing.Optional[str],
+    encoding: typing.Optional[str] = None,
+    negotiated: bool = False,
+) -> Response:
+    # compressed representations only share a weak validator with the plain one
+    headers = {"ETag": f'W/"{version}"' if encoding else f'"{version}"'}
+    if negotiated:
+        # caches must key every answer by Accept-Encoding, identity and 304 too
+        headers["Vary"] = "Accept-Encoding"
+    tags = parseETags(if_none_match)
+    if version in tags or "*" in tags:
+        return Response(status_code=304, headers=headers)
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(body, media_type="application/json", headers=headers)
+
+
+def services_response(
+    rendered: RenderedServices,
+    format: str,
+    if_none_match: typing.Optional[str],
+    accept_encoding: typing.Optional[str],
+) -> Response:
+    encoding = negotiateEncoding(accept_encoding, len(rendered.encode(format)))
+    return conditional_response(
+        rendered.encode(format, encoding),
+        rendered.version,
+        if_none_match,
+        encoding,
+        negotiated=True,
+    )
+
+
+@app.get("/metrics")
+def get_metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.get("/readyz")
+def readyz():
+    if not synced():
+        return Response(
+            "initial sync in progress",
+            status_code=503,
+            headers={"Retry-After": RETRY_AFTER},
+        )
+    return Response("ok")
 
 
 @app.get("/frps/{namespace}/{name}/config")
-def get_frps_config(namespace: str, name: str):
-    return FRPServer.get(name, namespace).config()
+@profiled(FRPServer)
+def get_frps_config(
+    namespace: str, name: str, if_none_match: typing.Optional[str] = Header(None)
+):
+    config = FRPServer.get_cached(name, namespace).config()
+    return conditional_response(
+        json.dumps(config).encode(), configVersion(config), if_none_match
+    )
 
 
-def matchLabelsBySelector(selector: Labels, labels: Labels):
-    for key, value in selector.items():
-        if labels.get(key, None) != value:
-            return False
-    return True
+ServicesFormat = typing.Literal["config", "proxies"]
+T = typing.TypeVar("T")
+
+
+# profiled here rather than on the long-poll routes, a profile of those would
+# hold the loop thread's profiler for the whole wait
+@profiled(FRPClient)
+def render_frpc_services_config(namespace: str, name: str) -> RenderedServices:
+    ensure_synced()
+    return services.get(FRPClient.get_cached(name, namespace))
 
 
 @app.get("/frpc/{namespace}/{name}/config/services")
-def get_frpc_services_config(namespace: str, name: str):
-    client = FRPClient.get(name, namespace)
-    selectedNamespaces = [namespaces[namespace]]
-    selectedEnpoints: typing.List[FRPClientEndpointModel] = []
+@profiled(FRPClient)
+def get_frpc_services_config(
+    namespace: str,
+    name: str,
+    format: ServicesFormat = "config",
+    if_none_match: typing.Optional[str] = Header(None),
+    accept_encoding: typing.Optional[str] = Header(None),
+):
+    rendered = render_frpc_services_config(namespace=namespace, name=name)
+    return services_response(rendered, format, if_none_match, accept_encoding)
+
 
-    if client.spec.namespaceSelector is not None:
-        selectedNamespaces = []
-        for ns in namespaces.values():
-            if matchLabelsBySelector(client.spec.namespaceSelector, ns.metadata.labels):
-                selectedNamespaces.append(ns)
+@app.get("/frpc/{namespace}/{name}/config/services/watch")
+async def watch_frpc_services_config(
+    namespace: str,
+    name: str,
+    version: typing.Optional[str] = None,
+    timeout: float = 60,
+    format: ServicesFormat = "config",
+    if_none_match: typing.Optional[str] = Header(None),
+    accept_encoding: typing.Optional[str] = Header(None),
+):
+    """
+    Long-poll variant of get_frpc_services_config: returns as soon as the rendered
+    config differs from the last-seen version (`version` or If-None-Match) and the
+    current burst of changes has settled, or 304 Not Modified once `timeout` expires.
+    """
+    known = parseETags(if_none_match)
+    if version is not None:
+        known.append(version)
+    rendered = await long_poll(
+        lambda: render_frpc_services_config(namespace=namespace, name=name),
+        lambda rendered: rendered.version not in known
+        and not settling(rendered.selection),
+        lambda rendered: [rendered],
+        timeout,
+    )
+    # encoding the proxies JSON and compressing it is too slow for the loop
+    return await run_in_threadpool(
+        services_response, rendered, format, ",".join(known), accept_encoding
+    )
 
-    for ns in selectedNamespaces:
-        for endpoint in endpoints.get(ns.metadata.name, {}).values():
-            if matchLabelsBySelector(client.spec.selector, endpoint.metadata.labels):
-                selectedEnpoints.append(endpoint)
 
-    return {"config": "\n".join(map(FRPClientEndpointModel.config, selectedEnpoints))}
+async def long_poll(
+    render: typing.Callable[[], T],
+    isNew: typing.Callable[[T], bool],
+    entries: typing.Callable[[T], typing.Iterable[RenderedServices]],
+    timeout: float,
+) -> T:
+    """
+    Render in the threadpool until isNew(rendered), re-rendering whenever one of
+    the selections it is made of changed, or return the last rendering once
+    `timeout` (at most 300s) expires
+    """
+    deadline = asyncio.get_running_loop().time() + min(timeout, 300)
+    while True:
+        rendered = await run_in_threadpool(render)
+        selections = {entry.selection: entry for entry in entries(rendered)}
+        remaining = deadline - asyncio.get_running_loop().time()
+        if loop is None or remaining <= 0:
+            return rendered
+        if isNew(rendered):
+            return rendered
+        if not all(map(services.isCurrent, selections.values())):
+            # invalidated since rendering, its wake may already have passed
+            continue
+        try:
+            await wait_for_selections(selections, remaining)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def wait_for_selections(
+    selections: typing.Iterable[SelectionKey], timeout: float
+):
+    """
+    Wait until one of the selections was woken by a change
+    """
+    selections = list(selections)
+    waiters = []
+    for selection in selections:
+        waiting[selection] += 1
+        waiters.append(
+            asyncio.ensure_future(events.setdefault(selection, asyncio.Event()).wait())
+        )
+    try:
+        if not waiters:
+            await asyncio.sleep(timeout)
+            raise asyncio.TimeoutError()
+        done, _ = await asyncio.wait(
+            waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+        )
+        if not done:
+            raise asyncio.TimeoutError()
+    finally:
+        for waiter in waiters:
+            waiter.cancel()
+        for selection in selections:
+            waiting[selection] -= 1
+            if waiting[selection] <= 0:
+                # last waiter gone, no need to keep or wake its event
+                del waiting[selection]
+                events.pop(selection, None)
+                pending = flushes.pop(selection, None)
+                if pending is not None:
+                    pending[0].cancel()
+
+
+class ServicesVersion(BaseModel):
+    namespace: str
+    name: str
+    version: typing.Optional[str] = None
+
+
+class ServicesBatch(BaseModel):
+    clients: typing.List[ServicesVersion]
+    format: ServicesFormat = "config"
+
+
+@profiled()
+def render_services_batch(batch: ServicesBatch):
+    """
+    Services configs of the batch's clients whose version differs from the one
+    they know (and that are not settling), the clients that do not exist
+    (anymore) and all rendered configs of the batch
+    """
+    ensure_synced()
+    changed: typing.List[typing.Tuple[ServicesVersion, RenderedServices]] = []
+    missing: typing.List[ServicesVersion] = []
+    entries: typing.List[RenderedServices] = []
+    for client in batch.clients:
+        try:
+            frpc = FRPClient.get_cached(client.name, client.namespace)
+        except ObjectDoesNotExist:
+            missing.append(client)
+            continue
+        rendered = services.get(frpc)
+        entries.append(rendered)
+        if rendered.version != client.version and not settling(rendered.selection):
+            changed.append((client, rendered))
+    return changed, missing, entries
+
+
+@app.post("/frpc/config/services")
+async def batch_frpc_services_config(
+    batch: ServicesBatch,
+    timeout: float = 0,
+    accept_encoding: typing.Optional[str] = Header(None),
+):
+    """
+    Services configs of many FRPClients in one request, e.g. for a node agent
+    serving all frpc pods of its node. Only configs whose version differs from
+    the one sent are returned; with a `timeout` the request is held until at
+    least one did change, like the watch route.
+    """
+    changed, missing, _ = await long_poll(
+        lambda: render_services_batch(batch),
+        lambda result: bool(result[0]),
+        lambda result: result[2],
+        timeout,
+    )
+    # splice the cached per-client bodies instead of encoding them again
+    items = b",".join(
+        json.dumps({"namespace": client.namespace, "name": client.name})[:-1].encode()
+        + b', "services": '
+        + rendered.encode(batch.format)
+        + b"}"
+        for client, rendered in changed
+    )
+    body = (
+        b'{"changed": ['
+        + items
+        + b'], "missing": '
+        + json.dumps([client.dict(exclude={"version"}) for client in missing]).encode()
+        + b"}"
+    )
+    # batches differ per caller, so they are compressed per request
+    headers = {"Vary": "Accept-Encoding"}
+    encoding = negotiateEncoding(accept_encoding, len(body))
+    if encoding:
+        body = await run_in_threadpool(compress, body, encoding)
+        headers["Content-Encoding"] = encoding
+    return Response(body, media_type="application/json", headers=headers)
 
 
 class AsyncServer(Server):
@@ -78,7 +591,31 @@ def run_async(app: typing.Union[ASGIApplication, str], **kwargs: typing.Any) ->
         os.remove(config.uds)
 
 
+def serve():
+    """
+    Serve configs from this process only, with WORKERS uvicorn worker processes
+    that each keep their own informer-fed state. Every worker has its own metrics
+    registry and /metrics only shows the one that answered, so deployments scale
+    by replicas with a single worker each
+    """
+    os.environ["APISERVER_MODE"] = "standalone"
+    uvicorn.run(
+        "apiserver:app",
+        port=int(getenv("PORT", 4032)),
+        host="0.0.0.0",
+        workers=int(getenv("WORKERS", 1)),
+    )
+
+
+# embedded: served from the kopf operator loop (default)
+# external: the operator does not serve configs, run `python apiserver.py` next to it
+# standalone: set by serve() for its worker processes
+MODE = getenv("APISERVER_MODE", "embedded")
+
 if __name__ == "__main__":
-    uvicorn.run(app, port=int(getenv("PORT", 4032)), host="0.0.0.0")  # type: ignore
-else:
+    serve()
+elif MODE == "standalone":
+    app.add_event_handler("startup", start_informers)
+    app.add_event_handler("shutdown", stop_informers)
+elif MODE == "embedded":
     run_async(app, port=int(getenv("PORT", 4032)), host="0.0.0.0")  # type: ignore
@@ -0,0 +1,157 @@
+import json
+import ssl
+import time
+import typing
+
+import aiohttp
+import requests
+from pykube.exceptions import HTTPError
+from pykube.http import HTTPClient
+
+from metrics import observe_kube_request
+
+
+class AsyncResponse(object):
+    def __init__(self, status: int, content_type: str, body: bytes):
+        self.status = status
+        self.content_type = content_type
+        self.body = body
+
+    @property
+    def ok(self):
+        return self.status < 400
+
+    def json(self):
+        return json.loads(self.body)
+
+    def raise_for_status(self):
+        if self.ok:
+            return
+        message = self.body.decode(errors="replace")
+        if self.content_type == "application/json":
+            payload = self.json()
+            if payload.get("kind") == "Status":
+                message = payload["message"]
+        raise HTTPError(self.status, message)
+
+
+class AsyncHTTPClient(object):
+    """
+    asyncio counterpart of pykube.HTTPClient: builds URLs, TLS and credentials from
+    the wrapped client and sends requests through a pool of keep-alive connections
+    """
+
+    def __init__(self, api: HTTPClient, limit: int = 32):
+        self.api = api
+        self.limit = limit
+        self._session: typing.Optional[aiohttp.ClientSession] = None
+        self._authorization: typing.Optional[str] = None
+
+    def _adapter(self):
+        return self.api.session.get_adapter(self.api.url)
+
+    def _ssl_context(self):
+        kwargs: typing.Dict[str, typing.Any] = {}
+        self._adapter()._setup_request_certificates(self.api.config, None, kwargs)
+        verify = kwargs.get("verify", True)
+        if verify is False:
+            return False
+        context = ssl.create_default_context(
+            cafile=verify if isinstance(verify, str) else None
+        )
+        if "cert" in kwargs:
+            context.load_cert_chain(*kwargs["cert"])
+        return context
+
+    def _authorize(self, refresh=False):
+        if self._authorization is None or refresh:
+            request = requests.Request("GET", self.api.url).prepare()
+            self._adapter()._setup_request_auth(self.api.config, request, {})
+            self._authorization = request.headers.get("Authorization", "")
+        return self._authorization
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.limit, ssl=self._ssl_context()
+                ),
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    def _request_kwargs(self, kwargs: dict, refresh=False):
+        headers = dict(kwargs.get("headers") or {})
+        if kwargs.get("data") is not None:
+            headers.setdefault("Content-Type", "application/json")
+        authorization = self._authorize(refresh)
+        if authorization:
+            headers["Authorization"] = authorization
+        return dict(
+            params=kwargs.get("params"),
+            data=kwargs.get("data"),
+            headers=headers,
+            timeout=aiohttp.ClientTimeout(total=kwargs["timeout"]),
+        )
+
+    async def _send(self, method: str, kwargs: dict, refresh=False):
+        async with self.session.request(
+            method, kwargs["url"], **self._request_kwargs(kwargs, refresh)
+        ) as response:
+            return AsyncResponse(
+                response.status, response.content_type, await response.read()
+            )
+
+    async def request(self, method: str, **kwargs) -> AsyncResponse:
+        """
+        Same keyword arguments as pykube.HTTPClient.request (url, version, namespace,
+        headers, data, ...)
+        """
+        kwargs = self.api.get_kwargs(**kwargs)
+        started = time.perf_counter()
+        response = await self._send(method, kwargs)
+        if response.status == 401:
+            # credentials may have expired, refresh them once
+            response = await self._send(method, kwargs, refresh=True)
+        observe_kube_request(
+            method, kwargs["url"], response.status, time.perf_counter() - started
+        )
+        return response
+
+    async def watch(self, **kwargs) -> typing.AsyncIterator[dict]:
+        """
+        Stream the events of a watch request (params must contain watch=true),
+        yields decoded {"type": ..., "object": ...} events
+        """
+        kwargs = self.api.get_kwargs(timeout=None, **kwargs)
+        async with self.session.get(
+            kwargs["url"], **self._request_kwargs(kwargs)
+        ) as response:
+            if response.status >= 400:
+                AsyncResponse(
+                    response.status, response.content_type, await response.read()
+                ).raise_for_status()
+            # events can be larger than the line limit of StreamReader.readline
+            buffer = b""
+            async for chunk in response.content.iter_any():
+                buffer += chunk
+                *lines, buffer = buffer.split(b"\n")
+                for line in lines:
+                    if line.strip():
+                        yield json.loads(line)
+
+    async def get(self, **kwargs):
+        return await self.request("GET", **kwargs)
+
+    async def post(self, **kwargs):
+        return await self.request("POST", **kwargs)
+
+    async def patch(self, **kwargs):
+        return await self.request("PATCH", **kwargs)
+
+    async def delete(self, **kwargs):
+        return await self.request("DELETE", **kwargs)
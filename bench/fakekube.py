@@ -0,0 +1,610 @@
+"""
+In-memory fake of the Kubernetes API, just enough for the operator: discovery,
+get/list/watch, create, merge and server-side apply patches and delete of the
+resources below. Runs an aiohttp server on its own thread and event loop.
+"""
+
+import asyncio
+import collections
+import copy
+import json
+import threading
+import typing
+import uuid
+
+from aiohttp import web
+
+# apiVersion -> plural -> (kind, namespaced)
+RESOURCES = {
+    "v1": {
+        "namespaces": ("Namespace", False),
+        "secrets": ("Secret", True),
+        "services": ("Service", True),
+        "configmaps": ("ConfigMap", True),
+    },
+    "apps/v1": {
+        "deployments": ("Deployment", True),
+    },
+    "coordination.k8s.io/v1": {
+        "leases": ("Lease", True),
+    },
+    "frp.nonamestudio.me/v1": {
+        "frpservers": ("FRPServer", True),
+        "frpclients": ("FRPClient", True),
+        "frpclientendpoints": ("FRPClientEndpoint", True),
+    },
+}
+
+Key = typing.Tuple[typing.Optional[str], str]
+
+
+def merge(target: dict, patch: dict):
+    """
+    JSON merge patch (RFC 7386), also good enough for server-side apply of the
+    operator's fully specified objects
+    """
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            merge(target[key], value)
+        else:
+            target[key] = copy.deepcopy(value)
+    return target
+
+
+# metadata a manager can own, the rest is maintained by the server
+OWNED_METADATA = ("labels", "annotations", "ownerReferences", "finalizers")
+
+# a field as the tokens of its managedFields entry, e.g. ("f:spec", "f:ports",
+# 'k:{"port":80,"protocol":"TCP"}', "f:name")
+Path = typing.Tuple[str, ...]
+
+
+def listKey(item) -> typing.Optional[dict]:
+    """
+    Key of an item of a list-map, as the api server merges containers, env,
+    volumes and ports; None for items of atomic lists
+    """
+    if not isinstance(item, dict):
+        return None
+    if "containerPort" in item:
+        return {
+            "containerPort": item["containerPort"],
+            "protocol": item.get("protocol", "TCP"),
+        }
+    if "port" in item:
+        return {"port": item["port"], "protocol": item.get("protocol", "TCP")}
+    if "name" in item:
+        return {"name": item["name"]}
+    return None
+
+
+def isListMap(items: list):
+    return bool(items) and all(listKey(item) is not None for item in items)
+
+
+def keyToken(key: dict):
+    return "k:" + json.dumps(key, sort_keys=True, separators=(",", ":"))
+
+
+def fieldPaths(obj: dict, prefix: Path = ()) -> typing.Set[Path]:
+    paths: typing.Set[Path] = set()
+    for key, value in obj.items():
+        path = prefix + (f"f:{key}",)
+        if isinstance(value, dict) and value:
+            paths |= fieldPaths(value, path)
+        elif isinstance(value, list) and isListMap(value):
+            for item in value:
+                itemPath = path + (keyToken(listKey(item)),)  # type: ignore
+                paths.add(itemPath)
+                paths |= fieldPaths(item, itemPath)
+        else:
+            paths.add(path)
+    return paths
+
+
+def ownedPaths(obj: dict):
+    """
+    Fields a write of obj claims for its manager
+    """
+    owned = {
+        key: value
+        for key, value in obj.items()
+        if key not in ("apiVersion", "kind", "metadata", "status")
+    }
+    metadata = {
+        key: value
+        for key, value in (obj.get("metadata") or {}).items()
+        if key in OWNED_METADATA and value not in (None, {}, [])
+    }
+    if metadata:
+        owned["metadata"] = metadata
+    return fieldPaths(owned)
+
+
+def toFieldsV1(paths: typing.Iterable[Path]):
+    fields: dict = {}
+    for path in paths:
+        node = fields
+        for token in path:
+            node = node.setdefault(token, {})
+        if path[-1].startswith("k:"):
+            node["."] = {}
+    return fields
+
+
+def fromFieldsV1(fields: dict, prefix: Path = ()) -> typing.Set[Path]:
+    paths: typing.Set[Path] = set()
+    for token, children in fields.items():
+        if token == ".":
+            paths.add(prefix)
+        elif children:
+            paths |= fromFieldsV1(children, prefix + (token,))
+        else:
+            paths.add(prefix + (token,))
+    return paths
+
+
+def locate(obj: dict, path: Path):
+    """
+    Container and key/index of the field at path, None when it is not set
+    """
+    node: typing.Any = obj
+    parent: typing.Any = None
+    key: typing.Any = None
+    for token in path:
+        if token.startswith("f:"):
+            if not isinstance(node, dict) or token[2:] not in node:
+                return None
+            parent, key = node, token[2:]
+        else:
+            if not isinstance(node, list):
+                return None
+            wanted = json.loads(token[2:])
+            for index, item in enumerate(node):
+                if listKey(item) == wanted:
+                    parent, key = node, index
+                    break
+            else:
+                return None
+        node = parent[key]
+    return parent, key
+
+
+MISSING = object()
+
+
+def valueAt(obj: dict, path: Path):
+    location = locate(obj, path)
+    return MISSING if location is None else location[0][location[1]]
+
+
+def applyMerge(target: dict, patch: dict):
+    """
+    Merge an applied configuration: maps recursively, list-maps by item key,
+    other lists are replaced
+    """
+    for key, value in patch.items():
+        current = target.get(key)
+        if isinstance(value, dict) and isinstance(current, dict):
+            applyMerge(current, value)
+        elif (
+            isinstance(value, list)
+            and isinstance(current, list)
+            and isListMap(value + current)
+        ):
+            items = {keyToken(listKey(item)): item for item in current}  # type: ignore
+            for item in value:
+                existing = items.get(keyToken(listKey(item)))  # type: ignore
+                if existing is None:
+                    current.append(copy.deepcopy(item))
+                else:
+                    applyMerge(existing, item)
+        else:
+            target[key] = copy.deepcopy(value)
+    return target
+
+
+def jsonPatch(target: dict, operations: typing.List[dict]):
+    """
+    JSON patch (RFC 6902) with the operations the operator sends, raises
+    ValueError when a test fails
+    """
+    for operation in operations:
+        *parents, last = [
+            token.replace("~1", "/").replace("~0", "~")
+            for token in operation["path"].split("/")[1:]
+        ]
+        node = target
+        for token in parents:
+            node = node[int(token)] if isinstance(node, list) else node[token]
+        if operation["op"] == "test":
+            if node.get(last) != operation["value"]:
+                raise ValueError(f"test of {operation['path']} failed")
+        elif operation["op"] in ("add", "replace"):
+            node[last] = copy.deepcopy(operation["value"])
+        elif operation["op"] == "remove":
+            del node[last]
+    return target
+
+
+def isPrefix(prefix: Path, path: Path):
+    return path[: len(prefix)] == prefix
+
+
+class Collection(object):
+    def __init__(self, apiVersion: str, kind: str, namespaced: bool):
+        self.apiVersion = apiVersion
+        self.kind = kind
+        self.namespaced = namespaced
+        self.objects: typing.Dict[Key, dict] = {}
+        self.events: typing.List[typing.Tuple[int, str, dict]] = []
+
+
+class FakeKube(object):
+    def __init__(self):
+        self.collections = {
+            (apiVersion, plural): Collection(apiVersion, kind, namespaced)
+            for apiVersion, plurals in RESOURCES.items()
+            for plural, (kind, namespaced) in plurals.items()
+        }
+        self.resourceVersion = 0
+        self.lock = threading.RLock()
+        self.calls: typing.Counter[typing.Tuple[str, str]] = collections.Counter()
+        self.loop: typing.Optional[asyncio.AbstractEventLoop] = None
+        self.changed: typing.Optional[asyncio.Condition] = None
+        self.runner: typing.Optional[web.AppRunner] = None
+        self.port = 0
+
+    # storage, safe to call from any thread
+
+    def _record(self, collection: Collection, type: str, obj: dict):
+        collection.events.append((self.resourceVersion, type, copy.deepcopy(obj)))
+
+    def _stamp(self, collection: Collection, obj: dict):
+        self.resourceVersion += 1
+        obj["apiVersion"] = collection.apiVersion
+        obj["kind"] = collection.kind
+        metadata = obj.setdefault("metadata", {})
+        metadata.setdefault("uid", str(uuid.uuid4()))
+        metadata.setdefault("creationTimestamp", "2000-01-01T00:00:00Z")
+        metadata["resourceVersion"] = str(self.resourceVersion)
+        return obj
+
+    def put(self, apiVersion: str, plural: str, obj: dict):
+        """
+        Create or replace an object without going through HTTP, for seeding
+        """
+        collection = self.collections[(apiVersion, plural)]
+        with self.lock:
+            obj = self._stamp(collection, copy.deepcopy(obj))
+            metadata = obj["metadata"]
+            key = (metadata.get("namespace"), metadata["name"])
+            type = "MODIFIED" if key in collection.objects else "ADDED"
+            collection.objects[key] = obj
+            self._record(collection, type, obj)
+        self._notify()
+        return obj
+
+    def remove(self, apiVersion: str, plural: str, namespace, name: str):
+        collection = self.collections[(apiVersion, plural)]
+        with self.lock:
+            obj = collection.objects.pop((namespace, name), None)
+            if obj is not None:
+                self.resourceVersion += 1
+                self._record(collection, "DELETED", obj)
+        if obj is not None:
+            self._notify()
+        return obj
+
+    def _notify(self):
+        if self.loop is None or self.changed is None:
+            return
+
+        async def notify():
+            assert self.changed
+            async with self.changed:
+                self.changed.notify_all()
+
+        if self._on_loop():
+            self.loop.create_task(notify())
+        else:
+            asyncio.run_coroutine_threadsafe(notify(), self.loop)
+
+    def _on_loop(self):
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    # http
+
+    def _parse(self, path: str):
+        bits = [bit for bit in path.split("/") if bit]
+        if bits[:2] == ["api", "v1"]:
+            apiVersion, bits = "v1", bits[2:]
+        elif bits[:1] == ["apis"] and len(bits) >= 3:
+            apiVersion, bits = f"{bits[1]}/{bits[2]}", bits[3:]
+        else:
+            return None
+        namespace = None
+        if len(bits) >= 3 and bits[0] == "namespaces":
+            namespace, bits = bits[1], bits[2:]
+        plural = bits[0] if bits else None
+        name = bits[1] if len(bits) > 1 else None
+        return apiVersion, plural, namespace, name
+
+    @staticmethod
+    def _status(code: int, message: str):
+        return web.json_response(
+            {"kind": "Status", "status": "Failure", "code": code, "message": message},
+            status=code,
+        )
+
+    def _discovery(self, apiVersion: str):
+        return web.json_response(
+            {
+                "kind": "APIResourceList",
+                "groupVersion": apiVersion,
+                "resources": [
+                    {"name": plural, "kind": kind, "namespaced": namespaced}
+                    for plural, (kind, namespaced) in RESOURCES.get(
+                        apiVersion, {}
+                    ).items()
+                ],
+            }
+        )
+
+    async def handle(self, request: web.Request):
+        parsed = self._parse(request.path)
+        if parsed is None:
+            return self._status(404, "not found")
+        apiVersion, plural, namespace, name = parsed
+        if plural is None:
+            return self._discovery(apiVersion)
+        collection = self.collections.get((apiVersion, plural))
+        if collection is None:
+            return self._status(404, f"unknown resource {plural}")
+        watch = request.query.get("watch") == "true"
+        self.calls[("WATCH" if watch else request.method, plural)] += 1
+
+        if request.method == "GET" and watch:
+            return await self._watch(request, collection, namespace)
+        if request.method == "GET" and name is None:
+            with self.lock:
+                items = [
+                    obj
+                    for key, obj in collection.objects.items()
+                    if namespace is None or key[0] == namespace
+                ]
+                resourceVersion = self.resourceVersion
+            return web.json_response(
+                {
+                    "kind": f"{collection.kind}List",
+                    "apiVersion": collection.apiVersion,
+                    "metadata": {"resourceVersion": str(resourceVersion)},
+                    "items": [
+                        {
+                            key: value
+                            for key, value in obj.items()
+                            if key not in ("apiVersion", "kind")
+                        }
+                        for obj in items
+                    ],
+                }
+            )
+
+        # the api server names the manager of a write by its user agent
+        manager = (
+            request.query.get("fieldManager")
+            or request.headers.get("User-Agent", "").partition("/")[0]
+        )
+
+        if request.method == "POST":
+            obj = await request.json()
+            key = (namespace, obj["metadata"]["name"])
+            if key in collection.objects:
+                return self._status(409, f"{key[1]} already exists")
+            obj["metadata"]["namespace"] = namespace
+            obj["metadata"]["managedFields"] = self._update(None, obj, manager)
+            return web.json_response(self.put(apiVersion, plural, obj), status=201)
+
+        key = (namespace, name or "")
+        current = collection.objects.get(key)
+        if request.method == "GET":
+            if current is None:
+                return self._status(404, f"{name} not found")
+            return web.json_response(current)
+        if request.method == "PATCH":
+            patch = json.loads(await request.text())
+            apply = request.content_type == "application/apply-patch+yaml"
+            if current is None and not apply:
+                return self._status(404, f"{name} not found")
+            if apply:
+                force = request.query.get("force") == "true"
+                try:
+                    obj = self._apply(current, patch, manager, force)
+                except ValueError as e:
+                    return self._status(409, str(e))
+            elif request.content_type == "application/json-patch+json":
+                # only used to rewrite managedFields, which records no manager
+                try:
+                    obj = jsonPatch(copy.deepcopy(current), patch)
+                except (ValueError, KeyError, IndexError) as e:
+                    return self._status(422, str(e))
+            else:
+                # a resourceVersion in the patch makes it conditional
+                resourceVersion = (patch.get("metadata") or {}).get("resourceVersion")
+                if resourceVersion not in (
+                    None,
+                    current["metadata"]["resourceVersion"],
+                ):
+                    return self._status(409, f"{name} was modified")
+                obj = merge(copy.deepcopy(current), patch)
+                obj["metadata"]["managedFields"] = self._update(current, patch, manager)
+            obj["metadata"]["name"] = name
+            if namespace is not None:
+                obj["metadata"]["namespace"] = namespace
+            return web.json_response(self.put(apiVersion, plural, obj))
+        if request.method == "DELETE":
+            if self.remove(apiVersion, plural, namespace, key[1]) is None:
+                return self._status(404, f"{name} not found")
+            return web.json_response({"kind": "Status", "status": "Success"})
+        return self._status(405, "method not allowed")
+
+    # server-side apply: field ownership by manager
+
+    @staticmethod
+    def _update(current: typing.Optional[dict], body: dict, manager: str):
+        """
+        managedFields after a create or update: the manager's Update entry owns
+        what it sent, other owners stay as they are
+        """
+        managed = copy.deepcopy(
+            ((current or {}).get("metadata") or {}).get("managedFields") or []
+        )
+        paths = ownedPaths(body)
+        for entry in managed:
+            if entry["manager"] == manager and entry["operation"] == "Update":
+                entry["fieldsV1"] = toFieldsV1(paths | fromFieldsV1(entry["fieldsV1"]))
+                return managed
+        managed.append(
+            {
+                "manager": manager,
+                "operation": "Update",
+                "apiVersion": body.get("apiVersion"),
+                "fieldsType": "FieldsV1",
+                "fieldsV1": toFieldsV1(paths),
+            }
+        )
+        return managed
+
+    @staticmethod
+    def _apply(current: typing.Optional[dict], applied: dict, manager: str, force):
+        """
+        Server-side apply: fields the manager applied before and no longer
+        applies are removed unless another manager owns them too. Fields applied
+        with a value that differs from the current one conflict, with force the
+        manager takes them over, without it the apply fails
+        """
+        obj = copy.deepcopy(current or {"metadata": {}})
+        managed = obj["metadata"].pop("managedFields", None) or []
+        new = ownedPaths(applied)
+        previous: typing.Set[Path] = set()
+        others = []
+        for entry in managed:
+            paths = fromFieldsV1(entry.get("fieldsV1") or {})
+            if entry["manager"] == manager and entry["operation"] == "Apply":
+                previous = paths
+                continue
+            conflicts = {
+                path
+                for path in paths & new
+                if not path[-1].startswith("k:")
+                and valueAt(obj, path) != valueAt(applied, path)
+            }
+            if conflicts and not force:
+                raise ValueError(
+                    f"conflict with {entry['manager']}: "
+                    + ", ".join(".".join(path) for path in sorted(conflicts))
+                )
+            if paths - conflicts:
+                others.append((entry, paths - conflicts))
+
+        applyMerge(obj, applied)
+        owned = new.union(*(paths for _, paths in others))
+        for path in sorted(previous - new, key=len):
+            if not any(isPrefix(path, other) for other in owned):
+                location = locate(obj, path)
+                if location is not None:
+                    del location[0][location[1]]
+
+        obj["metadata"]["managedFields"] = [
+            dict(entry, fieldsV1=toFieldsV1(paths)) for entry, paths in others
+        ] + [
+            {
+                "manager": manager,
+                "operation": "Apply",
+                "apiVersion": applied.get("apiVersion"),
+                "fieldsType": "FieldsV1",
+                "fieldsV1": toFieldsV1(new),
+            }
+        ]
+        return obj
+
+    async def _watch(self, request: web.Request, collection: Collection, namespace):
+        assert self.changed
+        since = int(request.query.get("resourceVersion") or self.resourceVersion)
+        timeout = float(request.query.get("timeoutSeconds", 60))
+        response = web.StreamResponse(headers={"Content-Type": "application/json"})
+        await response.prepare(request)
+        deadline = asyncio.get_running_loop().time() + timeout
+        while True:
+            with self.lock:
+                events = list(collection.events)
+            for resourceVersion, type, obj in events:
+                if resourceVersion <= since:
+                    continue
+                since = resourceVersion
+                if namespace is not None and obj["metadata"].get("namespace") != (
+                    namespace
+                ):
+                    continue
+                line = json.dumps({"type": type, "object": obj}) + "\n"
+                await response.write(line.encode())
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                break
+            try:
+                async with self.changed:
+                    await asyncio.wait_for(self.changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        await response.write_eof()
+        return response
+
+    def start(self):
+        """
+        Serve on 127.0.0.1 from a background thread, returns the base url
+        """
+        started = threading.Event()
+
+        async def serve():
+            self.loop = asyncio.get_running_loop()
+            self.changed = asyncio.Condition()
+            app = web.Application()
+            app.router.add_route("*", "/{path:.*}", self.handle)
+            self.runner = web.AppRunner(app)
+            await self.runner.setup()
+            site = web.TCPSite(self.runner, "127.0.0.1", 0)
+            await site.start()
+            self.port = site._server.sockets[0].getsockname()[1]  # type: ignore
+            started.set()
+
+        thread = threading.Thread(
+            target=lambda: asyncio.run(self._forever(serve())), daemon=True
+        )
+        thread.start()
+        started.wait()
+        return f"http://127.0.0.1:{self.port}"
+
+    async def _forever(self, setup):
+        await setup
+        await asyncio.Event().wait()
+
+    def kubeconfig(self):
+        return (
+            "apiVersion: v1\n"
+            "kind: Config\n"
+            "clusters:\n"
+            f"- cluster: {{server: 'http://127.0.0.1:{self.port}'}}\n"
+            "  name: fake\n"
+            "contexts:\n"
+            "- context: {cluster: fake, user: fake, namespace: default}\n"
+            "  name: fake\n"
+            "current-context: fake\n"
+            "users:\n"
+            "- name: fake\n"
+            "  user: {token: fake}\n"
+        )
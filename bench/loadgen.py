@@ -0,0 +1,299 @@
+"""
+Load test of config serving: simulates sidecars polling or long-polling
+/frpc/{ns}/{name}/config/services against an in-process apiserver whose
+endpoint index is pre-populated, while endpoints are added and removed.
+
+    python bench/loadgen.py --sidecars 1000 --endpoints 10000 --churn 20
+
+Reports request throughput, latency percentiles and the propagation delay from
+an endpoint change to the first sidecar observing it.
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+import typing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aiohttp  # noqa: E402
+
+from fakekube import FakeKube  # noqa: E402
+from run import percentiles  # noqa: E402
+
+NAMESPACE = "load"
+
+
+def endpoint(name: str, client: str, port: int):
+    return {
+        "metadata": {
+            "name": name,
+            "namespace": NAMESPACE,
+            "labels": {"client": client},
+        },
+        "spec": {
+            "type": "tcp",
+            "local": {"host": name, "port": 8080},
+            "remote": {"port": port},
+        },
+    }
+
+
+class Stats(object):
+    def __init__(self):
+        self.latencies: typing.List[float] = []
+        self.statuses: typing.Counter[int] = collections.Counter()
+        self.errors = 0
+        self.bytes = 0
+        self.delays: typing.List[float] = []
+        # client -> section name -> (added, changed at)
+        self.pending: typing.Dict[str, typing.Dict[str, typing.Tuple[bool, float]]] = (
+            collections.defaultdict(dict)
+        )
+        self.lock = threading.Lock()
+
+    def changed(self, client: str, name: str, added: bool):
+        with self.lock:
+            self.pending[client][f"[{NAMESPACE}_{name}]"] = (added, time.perf_counter())
+
+    def observe(self, client: str, config: str):
+        now = time.perf_counter()
+        with self.lock:
+            pending = self.pending[client]
+            for section, (added, at) in list(pending.items()):
+                if (section in config) == added:
+                    self.delays.append(now - at)
+                    del pending[section]
+
+
+def populate(apiserver, args):
+    from resources.FRPClient import FRPClient
+    from resources.FRPClientEndpoint import FRPClientEndpointModel
+    from resources.Namespace import Namespace
+
+    apiserver.store_namespace(Namespace.parse_obj({"metadata": {"name": NAMESPACE}}))
+    clients = [f"frpc-{i}" for i in range(args.clients)]
+    for client in clients:
+        FRPClient.cache.put(
+            {
+                "apiVersion": FRPClient.apiVersion,
+                "kind": FRPClient.kind,
+                "metadata": {"name": client, "namespace": NAMESPACE},
+                "spec": {
+                    "target": {"host": "frps", "token": {"secret": "frp-token"}},
+                    "selector": {"client": client},
+                },
+            }
+        )
+    for i in range(args.endpoints):
+        apiserver.store_endpoint(
+            FRPClientEndpointModel.parse_obj(
+                endpoint(f"endpoint-{i}", clients[i % len(clients)], 10000 + i)
+            )
+        )
+    for informer in apiserver.syncInformers:
+        informer.synced = True
+    return clients
+
+
+def serve(apiserver, port: int):
+    import uvicorn
+
+    server = uvicorn.Server(
+        uvicorn.Config(apiserver.app, host="127.0.0.1", port=port, log_level="critical")
+    )
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    return server
+
+
+async def churn(apiserver, clients, stats: Stats, args, stop: asyncio.Event):
+    """
+    Add and remove endpoints at args.churn changes per second
+    """
+    from resources.FRPClientEndpoint import FRPClientEndpointModel
+
+    rng = random.Random(1)
+    live: typing.List[typing.Tuple[str, str]] = []
+    serial = 0
+    while not stop.is_set():
+        await asyncio.sleep(1 / args.churn)
+        if live and rng.random() < 0.5:
+            name, client = live.pop(rng.randrange(len(live)))
+            stats.changed(client, name, added=False)
+            apiserver.remove_endpoint(NAMESPACE, name)
+        else:
+            serial += 1
+            name, client = f"churn-{serial}", rng.choice(clients)
+            live.append((name, client))
+            stats.changed(client, name, added=True)
+            apiserver.store_endpoint(
+                FRPClientEndpointModel.parse_obj(endpoint(name, client, 30000 + serial))
+            )
+
+
+async def sidecar(
+    session: aiohttp.ClientSession,
+    base: str,
+    client: str,
+    stats: Stats,
+    args,
+    stop: asyncio.Event,
+):
+    url = f"{base}/frpc/{NAMESPACE}/{client}/config/services"
+    if args.mode == "watch":
+        url += "/watch"
+    version = None
+    # spread the first requests like sidecars starting at different times
+    await asyncio.sleep(random.random() * min(args.interval, 1))
+    while not stop.is_set():
+        headers = {"If-None-Match": f'"{version}"'} if version else {}
+        params = {"timeout": str(args.watch_timeout)} if args.mode == "watch" else {}
+        started = time.perf_counter()
+        try:
+            async with session.get(url, headers=headers, params=params) as response:
+                body = await response.read()
+                status = response.status
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            stats.errors += 1
+            await asyncio.sleep(1)
+            continue
+        elapsed = time.perf_counter() - started
+        stats.statuses[status] += 1
+        stats.bytes += len(body)
+        if args.mode == "poll" or status == 200:
+            stats.latencies.append(elapsed)
+        if status == 200:
+            services = json.loads(body)
+            version = services["version"]
+            stats.observe(client, services["config"])
+        if args.mode == "poll":
+            await asyncio.sleep(args.interval)
+
+
+async def load(apiserver, clients, base: str, args):
+    stats = Stats()
+    stop = asyncio.Event()
+    connector = aiohttp.TCPConnector(limit=0)
+    timeout = aiohttp.ClientTimeout(total=args.watch_timeout + 30)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        tasks = [
+            asyncio.create_task(
+                sidecar(session, base, clients[i % len(clients)], stats, args, stop)
+            )
+            for i in range(args.sidecars)
+        ]
+        # let every sidecar fetch its initial config before changing anything
+        await asyncio.sleep(min(args.interval, 1) + 1)
+        # counters only cover the measured duration, not the initial fetches
+        stats.statuses.clear()
+        stats.latencies.clear()
+        stats.errors = 0
+        stats.bytes = 0
+        started = time.perf_counter()
+        if args.churn > 0:
+            tasks.append(
+                asyncio.create_task(churn(apiserver, clients, stats, args, stop))
+            )
+        await asyncio.sleep(args.duration)
+        stop.set()
+        elapsed = time.perf_counter() - started
+        statuses = dict(stats.statuses)
+        requests = sum(statuses.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    return {
+        "sidecars": args.sidecars,
+        "mode": args.mode,
+        "seconds": elapsed,
+        "requests": requests,
+        "requests_per_second": requests / elapsed,
+        "statuses": statuses,
+        "errors": stats.errors,
+        "megabytes": stats.bytes / 1e6,
+        "latency": percentiles(stats.latencies),
+        "propagation": percentiles(stats.delays),
+        "propagated": len(stats.delays),
+        "unobserved": sum(len(pending) for pending in stats.pending.values()),
+    }
+
+
+def report(results: dict):
+    def ms(latency):
+        return " ".join(f"{key}={value * 1000:.1f}ms" for key, value in latency.items())
+
+    print(
+        f"{results['sidecars']} sidecars ({results['mode']}) for "
+        f"{results['seconds']:.1f}s: {results['requests']} requests "
+        f"({results['requests_per_second']:.0f}/s), statuses {results['statuses']}, "
+        f"{results['errors']} errors, {results['megabytes']:.1f}MB"
+    )
+    print(f"latency: {ms(results['latency'])}")
+    print(
+        f"propagation of {results['propagated']} changes "
+        f"({results['unobserved']} unobserved): {ms(results['propagation'])}"
+    )
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--sidecars", type=int, default=1000)
+    parser.add_argument(
+        "--clients", type=int, default=0, help="FRPClients (default: one per sidecar)"
+    )
+    parser.add_argument("--endpoints", type=int, default=10000)
+    parser.add_argument("--churn", type=float, default=10, help="changes per second")
+    parser.add_argument("--mode", choices=["watch", "poll"], default="watch")
+    parser.add_argument("--interval", type=float, default=5, help="poll interval")
+    parser.add_argument("--watch-timeout", type=float, default=30)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--json", action="store_true", help="print results as json")
+    args = parser.parse_args()
+    args.clients = args.clients or args.sidecars
+
+    kube = FakeKube()
+    kube.start()
+    kubeconfig = tempfile.NamedTemporaryFile("w", suffix=".yaml", delete=False)
+    kubeconfig.write(kube.kubeconfig())
+    kubeconfig.close()
+    os.environ["KUBECONFIG"] = kubeconfig.name
+    os.environ["APISERVER_MODE"] = "external"
+
+    import apiserver
+
+    clients = populate(apiserver, args)
+    port = free_port()
+    server = serve(apiserver, port)
+    try:
+        results = asyncio.run(
+            load(apiserver, clients, f"http://127.0.0.1:{port}", args)
+        )
+    finally:
+        server.should_exit = True
+        os.unlink(kubeconfig.name)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        report(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,335 @@
+"""
+Offline benchmark of the operator against bench/fakekube.py
+
+    python bench/run.py --servers 10 --clients 50 --endpoints 2000
+
+Reports reconcile throughput of the kopf handlers, Kubernetes API calls per
+phase, informer sync time, latency percentiles of the services config route and
+how long an endpoint change takes to reach a long-polling client. Everything
+runs with the shipped defaults, CONFIG_COALESCE_SECONDS included.
+"""
+
+import argparse
+import asyncio
+import base64
+import copy
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import typing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fakekube import FakeKube  # noqa: E402
+
+CRD = "frp.nonamestudio.me/v1"
+
+
+def percentiles(samples: typing.List[float]):
+    if len(samples) < 2:
+        return {"p50": samples[0] if samples else 0, "p95": 0, "p99": 0}
+    cuts = statistics.quantiles(samples, n=100, method="inclusive")
+    return {"p50": cuts[49], "p95": cuts[94], "p99": cuts[98], "max": max(samples)}
+
+
+def secret(namespace: str, name: str, **data: str):
+    return {
+        "metadata": {"name": name, "namespace": namespace},
+        "data": {k: base64.b64encode(v.encode()).decode() for k, v in data.items()},
+    }
+
+
+def endpoint(namespace: str, name: str, client: str, port: int):
+    return {
+        "metadata": {
+            "name": name,
+            "namespace": namespace,
+            "labels": {"client": client},
+        },
+        "spec": {
+            "type": "tcp",
+            "local": {"host": f"svc-{port}", "port": 8080},
+            "remote": {"port": port},
+        },
+    }
+
+
+def seed(kube: FakeKube, args):
+    namespaces = [f"bench-{i}" for i in range(args.namespaces)]
+    for namespace in namespaces:
+        kube.put(
+            "v1",
+            "namespaces",
+            {"metadata": {"name": namespace, "labels": {"bench": "true"}}},
+        )
+        kube.put("v1", "secrets", secret(namespace, "frp-token", token="t0"))
+
+    servers = []
+    for i in range(args.servers):
+        namespace = namespaces[i % len(namespaces)]
+        servers.append(
+            kube.put(
+                CRD,
+                "frpservers",
+                {
+                    "metadata": {"name": f"frps-{i}", "namespace": namespace},
+                    "spec": {"token": {"secret": "frp-token"}, "vhost": {"http": 80}},
+                },
+            )
+        )
+
+    clients = []
+    for i in range(args.clients):
+        namespace = namespaces[i % len(namespaces)]
+        clients.append(
+            kube.put(
+                CRD,
+                "frpclients",
+                {
+                    "metadata": {"name": f"frpc-{i}", "namespace": namespace},
+                    "spec": {
+                        "target": {"host": "frps", "token": {"secret": "frp-token"}},
+                        "selector": {"client": f"frpc-{i}"},
+                        "namespaceSelector": {"bench": "true"},
+                    },
+                },
+            )
+        )
+
+    for i in range(args.endpoints):
+        kube.put(
+            CRD,
+            "frpclientendpoints",
+            endpoint(
+                namespaces[i % len(namespaces)],
+                f"endpoint-{i}",
+                f"frpc-{i % max(args.clients, 1)}",
+                10000 + i,
+            ),
+        )
+    return servers, clients
+
+
+def api_calls(kube: FakeKube, before: typing.Counter):
+    return {
+        f"{verb} {plural}": count - before.get((verb, plural), 0)
+        for (verb, plural), count in sorted(kube.calls.items())
+        if count - before.get((verb, plural), 0)
+    }
+
+
+async def reconcile_all(objects, handler, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+    durations: typing.List[float] = []
+
+    async def one(obj):
+        async with semaphore:
+            started = time.perf_counter()
+            await handler(body=obj, meta=obj["metadata"])
+            durations.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(obj) for obj in objects))
+    return time.perf_counter() - started, durations
+
+
+def touch(kube: FakeKube, plural: str, objects):
+    """
+    The objects with a new resourceVersion and an unchanged spec, as kopf
+    hands them to update handlers after e.g. an annotation patch
+    """
+    touched = []
+    for obj in objects:
+        obj = copy.deepcopy(obj)
+        obj["metadata"].setdefault("annotations", {})["bench/touched"] = "true"
+        touched.append(kube.put(CRD, plural, obj))
+    return touched
+
+
+async def reconcile_phase(kube: FakeKube, servers, clients, args):
+    import k8s_operator
+    from context import asyncApi
+
+    try:
+        results = {}
+        for name, objects, handler in [
+            ("FRPServer", servers, k8s_operator.reconcile_frp_server),
+            ("FRPClient", clients, k8s_operator.reconcile_frp_client),
+            (
+                "FRPServer resync",
+                touch(kube, "frpservers", servers),
+                k8s_operator.reconcile_frp_server,
+            ),
+            (
+                "FRPClient resync",
+                touch(kube, "frpclients", clients),
+                k8s_operator.reconcile_frp_client,
+            ),
+        ]:
+            elapsed, durations = await reconcile_all(objects, handler, args.concurrency)
+            results[name] = {
+                "objects": len(objects),
+                "seconds": elapsed,
+                "per_second": len(objects) / elapsed if elapsed else 0,
+                "latency": percentiles(durations),
+            }
+        return results
+    finally:
+        # the informers of the next phase run on another event loop
+        await asyncApi.close()
+
+
+def watch_propagation(kube: FakeKube, client, clients, args):
+    """
+    Seconds from an endpoint change to the return of the long poll of the client
+    it belongs to
+    """
+    import threading
+
+    import apiserver
+
+    durations = []
+    for i in range(args.watches):
+        metadata = clients[i % len(clients)]["metadata"]
+        url = f"/frpc/{metadata['namespace']}/{metadata['name']}/config/services"
+        etag = client.get(url).headers["etag"]
+        waiters = sum(apiserver.waiting.values())
+        returned: typing.List[float] = []
+        watch = threading.Thread(
+            target=lambda: (
+                client.get(
+                    f"{url}/watch",
+                    params={"timeout": 60},
+                    headers={"If-None-Match": etag},
+                ),
+                returned.append(time.perf_counter()),
+            )
+        )
+        watch.start()
+        while sum(apiserver.waiting.values()) <= waiters:
+            time.sleep(0.001)
+        started = time.perf_counter()
+        kube.put(
+            CRD,
+            "frpclientendpoints",
+            endpoint(metadata["namespace"], f"watch-{i}", metadata["name"], 20000 + i),
+        )
+        watch.join()
+        durations.append(returned[0] - started)
+    return {"watches": len(durations), "latency": percentiles(durations)}
+
+
+def serving_phase(kube: FakeKube, clients, args):
+    import random
+
+    import apiserver
+    from fastapi.testclient import TestClient
+
+    apiserver.app.add_event_handler("startup", apiserver.start_informers)
+    apiserver.app.add_event_handler("shutdown", apiserver.stop_informers)
+    results: typing.Dict[str, typing.Any] = {}
+    with TestClient(apiserver.app) as client:
+        started = time.perf_counter()
+        while not apiserver.synced():
+            time.sleep(0.01)
+        # wait until the FRPClient informer has listed as well
+        while len(apiserver.informers[2].objects) < len(clients):
+            time.sleep(0.01)
+        results["informer_sync_seconds"] = time.perf_counter() - started
+
+        rng = random.Random(0)
+        versions: typing.Dict[str, str] = {}
+        for name, conditional in [("cold", False), ("200", False), ("304", True)]:
+            if name == "cold":
+                apiserver.services.rendered.clear()
+            durations = []
+            sizes = []
+            for _ in range(args.requests if name != "cold" else len(clients)):
+                obj = rng.choice(clients)
+                metadata = obj["metadata"]
+                url = (
+                    f"/frpc/{metadata['namespace']}/{metadata['name']}/config/services"
+                )
+                headers = {}
+                if conditional and url in versions:
+                    headers["If-None-Match"] = versions[url]
+                started = time.perf_counter()
+                response = client.get(url, headers=headers)
+                durations.append(time.perf_counter() - started)
+                sizes.append(len(response.content))
+                if response.status_code == 200:
+                    versions[url] = response.headers["etag"]
+            results[f"services_config_{name}"] = {
+                "requests": len(durations),
+                "latency": percentiles(durations),
+                "mean_bytes": statistics.mean(sizes) if sizes else 0,
+            }
+        results["watch_propagation"] = watch_propagation(kube, client, clients, args)
+    return results
+
+
+def report(results: dict):
+    def ms(latency):
+        return " ".join(f"{key}={value * 1000:.2f}ms" for key, value in latency.items())
+
+    for kind, result in results["reconcile"].items():
+        print(
+            f"reconcile {kind}: {result['objects']} in {result['seconds']:.2f}s "
+            f"({result['per_second']:.1f}/s) {ms(result['latency'])}"
+        )
+    print("kube api calls during reconcile:")
+    for call, count in results["reconcile_api_calls"].items():
+        print(f"  {call}: {count}")
+    print(f"informer sync: {results['serving']['informer_sync_seconds']:.2f}s")
+    for key, result in results["serving"].items():
+        if key.startswith("services_config_"):
+            print(
+                f"{key}: {result['requests']} requests, "
+                f"{result['mean_bytes']:.0f}B mean, {ms(result['latency'])}"
+            )
+    result = results["serving"]["watch_propagation"]
+    print(f"watch propagation: {result['watches']} changes, {ms(result['latency'])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--servers", type=int, default=10)
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--endpoints", type=int, default=1000)
+    parser.add_argument("--namespaces", type=int, default=5)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--watches", type=int, default=10)
+    parser.add_argument("--json", action="store_true", help="print results as json")
+    args = parser.parse_args()
+
+    kube = FakeKube()
+    kube.start()
+    kubeconfig = tempfile.NamedTemporaryFile("w", suffix=".yaml", delete=False)
+    kubeconfig.write(kube.kubeconfig())
+    kubeconfig.close()
+    # before any repository module creates its API clients
+    os.environ["KUBECONFIG"] = kubeconfig.name
+    os.environ["APISERVER_MODE"] = "external"
+
+    servers, clients = seed(kube, args)
+    results: typing.Dict[str, typing.Any] = {}
+    before = kube.calls.copy()
+    results["reconcile"] = asyncio.run(reconcile_phase(kube, servers, clients, args))
+    results["reconcile_api_calls"] = api_calls(kube, before)
+    before = kube.calls.copy()
+    results["serving"] = serving_phase(kube, clients, args)
+    results["serving_api_calls"] = api_calls(kube, before)
+    os.unlink(kubeconfig.name)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        report(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+import gzip
+import typing
+from os import getenv
+
+try:
+    import zstandard
+except ImportError:  # optional, gzip only without it
+    zstandard = None
+
+# in order of preference when a client accepts several
+ENCODINGS = ["zstd", "gzip"] if zstandard is not None else ["gzip"]
+# smaller bodies are not worth the client's decompression
+COMPRESS_MIN_BYTES = int(getenv("COMPRESS_MIN_BYTES", 1024))
+
+
+def negotiateEncoding(
+    acceptEncoding: typing.Optional[str], size: int
+) -> typing.Optional[str]:
+    """
+    Content-Encoding to answer an Accept-Encoding header with, None for identity
+    """
+    if not acceptEncoding or size < COMPRESS_MIN_BYTES:
+        return None
+    accepted: typing.Dict[str, float] = {}
+    for item in acceptEncoding.split(","):
+        coding, _, params = item.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0
+        accepted[coding.strip().lower()] = quality
+    for encoding in ENCODINGS:
+        if accepted.get(encoding, accepted.get("*", 0)) > 0:
+            return encoding
+    return None
+
+
+def compress(body: bytes, encoding: str, level: int = 6) -> bytes:
+    if encoding == "zstd":
+        assert zstandard is not None
+        return zstandard.ZstdCompressor(level=level).compress(body)
+    # no timestamp, so the same body always compresses to the same bytes
+    return gzip.compress(body, compresslevel=level, mtime=0)
@@ -1,7 +1,14 @@
 import pykube
 from contextvars import ContextVar
+from os import getenv
+
+from asyncclient import AsyncHTTPClient
+from metrics import observe_kube_response
 
 api = pykube.HTTPClient(pykube.KubeConfig.from_env())
+api.session.hooks["response"].append(observe_kube_response)
+asyncApi = AsyncHTTPClient(api, limit=int(getenv("KUBE_CONNECTIONS", 32)))
 
 kubeApi = ContextVar("kubeApi", default=api)
-ownerReferences = ContextVar("ownerReferences", default=[])
\ No newline at end of file
+asyncKubeApi = ContextVar("asyncKubeApi", default=asyncApi)
+ownerReferences = ContextVar("ownerReferences", default=[])
@@ -0,0 +1,115 @@
+import threading
+import typing
+
+from resources.common import Labels
+
+K = typing.TypeVar("K")
+V = typing.TypeVar("V")
+
+
+def matchLabelsBySelector(selector: Labels, labels: Labels):
+    for key, value in selector.items():
+        if labels.get(key, None) != value:
+            return False
+    return True
+
+
+class LabelIndex(typing.Generic[K, V]):
+    """
+    Objects keyed by K with an inverted (label key, value) -> keys index, so a
+    selector is evaluated as a set intersection instead of a scan over all objects
+    """
+
+    def __init__(self):
+        self.objects: typing.Dict[K, V] = {}
+        self.labels: typing.Dict[K, Labels] = {}
+        self.postings: typing.Dict[typing.Tuple[str, str], typing.Set[K]] = {}
+        self.lock = threading.RLock()
+
+    def put(self, key: K, obj: V, labels: Labels):
+        with self.lock:
+            self.pop(key)
+            self.objects[key] = obj
+            self.labels[key] = dict(labels)
+            for item in labels.items():
+                self.postings.setdefault(item, set()).add(key)
+
+    def pop(self, key: K, default: typing.Optional[V] = None):
+        with self.lock:
+            for item in self.labels.pop(key, {}).items():
+                keys = self.postings.get(item)
+                if keys is None:
+                    continue
+                keys.discard(key)
+                if not keys:
+                    del self.postings[item]
+            return self.objects.pop(key, default)
+
+    def get(self, key: K, default: typing.Optional[V] = None):
+        return self.objects.get(key, default)
+
+    def match(self, selector: Labels) -> typing.Optional[typing.Set[K]]:
+        """
+        Keys of objects matching the selector, None if the selector matches everything
+        """
+        if not selector:
+            return None
+        with self.lock:
+            candidates = sorted(
+                (self.postings.get(item, set()) for item in selector.items()), key=len
+            )
+            result = set(candidates[0])
+            for keys in candidates[1:]:
+                if not result:
+                    break
+                result &= keys
+            return result
+
+    def select(self, selector: Labels) -> typing.Set[K]:
+        with self.lock:
+            result = self.match(selector)
+            return set(self.objects) if result is None else result
+
+    def __contains__(self, key):
+        return key in self.objects
+
+    def __len__(self):
+        return len(self.objects)
+
+
+class EndpointIndex(LabelIndex[typing.Tuple[str, str], V]):
+    """
+    LabelIndex keyed by (namespace, name) that can also scope selection to namespaces
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.byNamespace: typing.Dict[str, typing.Set[typing.Tuple[str, str]]] = {}
+
+    def put(self, key: typing.Tuple[str, str], obj: V, labels: Labels):
+        with self.lock:
+            super().put(key, obj, labels)
+            self.byNamespace.setdefault(key[0], set()).add(key)
+
+    def pop(self, key: typing.Tuple[str, str], default: typing.Optional[V] = None):
+        with self.lock:
+            keys = self.byNamespace.get(key[0])
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.byNamespace[key[0]]
+            return super().pop(key, default)
+
+    def select(
+        self,
+        selector: Labels,
+        namespaces: typing.Optional[typing.Iterable[str]] = None,
+    ) -> typing.Set[typing.Tuple[str, str]]:
+        with self.lock:
+            if namespaces is None:
+                return super().select(selector)
+            scoped: typing.Set[typing.Tuple[str, str]] = set()
+            for namespace in namespaces:
+                scoped |= self.byNamespace.get(namespace, set())
+            result = self.match(selector)
+            return scoped if result is None else result & scoped
@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import typing
+
+from context import asyncKubeApi
+from resources.resource import Resource
+
+logger = logging.getLogger(__name__)
+
+Event = typing.Dict[str, typing.Any]
+
+
+class Informer(object):
+    """
+    List+watch loop over all objects of one kind that hands raw events
+    ({"type": ..., "object": ...}) to a callback. The first listing is delivered
+    with type None like kopf does; whenever the watch cannot be resumed the kind
+    is relisted and objects that disappeared meanwhile are delivered as DELETED.
+    Only objects keep() accepts are held in objects, all events reach the handler.
+    With after, the first listing waits until that informer is synced.
+    """
+
+    def __init__(
+        self,
+        resource: typing.Type[Resource],
+        handler: typing.Callable[[Event], None],
+        watchTimeout: int = 300,
+        retryDelay: float = 5,
+        keep: typing.Callable[[Event], bool] = lambda obj: True,
+        after: typing.Optional["Informer"] = None,
+    ):
+        self.resource = resource
+        self.handler = handler
+        self.watchTimeout = watchTimeout
+        self.retryDelay = retryDelay
+        self.keep = keep
+        self.after = after
+        self.resourceVersion: typing.Optional[str] = None
+        # whether objects are complete: listed once or restored from a snapshot
+        self.synced = False
+        # delivered events, bookmarks only move resourceVersion
+        self.changes = 0
+        self.objects: typing.Dict[typing.Tuple[typing.Optional[str], str], Event] = {}
+        self.task: typing.Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _key(obj: Event):
+        return (obj["metadata"].get("namespace"), obj["metadata"]["name"])
+
+    def _deliver(self, event: Event):
+        self.changes += 1
+        obj = event["object"]
+        if event["type"] == "DELETED" or not self.keep(obj):
+            self.objects.pop(self._key(obj), None)
+        else:
+            self.objects[self._key(obj)] = obj
+        try:
+            self.handler(event)
+        except Exception:
+            logger.exception("%s event handler failed", self.resource.kind)
+
+    def restore(self, items: typing.List[Event], resourceVersion: str):
+        """
+        Deliver objects of a previous run and resume watching from resourceVersion
+        """
+        for obj in items:
+            self._deliver({"type": None, "object": obj})
+        self.resourceVersion = resourceVersion
+        self.synced = True
+
+    async def _endpoint(self):
+        pykubeType = await self.resource._get_pykube_type_async()
+        return dict(url=pykubeType.endpoint, version=pykubeType.version)
+
+    async def list(self):
+        r = await asyncKubeApi.get().get(**await self._endpoint())
+        r.raise_for_status()
+        body = r.json()
+        previous = self.objects
+        self.objects = {}
+        for obj in body["items"]:
+            # list items come without apiVersion/kind
+            obj.setdefault("apiVersion", self.resource.apiVersion)
+            obj.setdefault("kind", self.resource.kind)
+            previous.pop(self._key(obj), None)
+            self._deliver({"type": None, "object": obj})
+        for obj in previous.values():
+            self._deliver({"type": "DELETED", "object": obj})
+        self.resourceVersion = body["metadata"]["resourceVersion"]
+        self.synced = True
+
+    async def watch(self):
+        params = {
+            "watch": "true",
+            "allowWatchBookmarks": "true",
+            "resourceVersion": self.resourceVersion,
+            "timeoutSeconds": str(self.watchTimeout),
+        }
+        async for event in asyncKubeApi.get().watch(
+            **await self._endpoint(), params=params
+        ):
+            obj = event["object"]
+            if event["type"] == "ERROR":
+                # 410 Gone: resourceVersion is too old to resume from
+                if obj.get("code") == 410:
+                    self.resourceVersion = None
+                    return
+                raise RuntimeError(obj.get("message"))
+            self.resourceVersion = obj["metadata"]["resourceVersion"]
+            if event["type"] != "BOOKMARK":
+                self._deliver(event)
+
+    async def run(self):
+        while self.after is not None and not self.after.synced:
+            await asyncio.sleep(0.1)
+        while True:
+            try:
+                if self.resourceVersion is None:
+                    await self.list()
+                await self.watch()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("%s watch failed, relisting", self.resource.kind)
+                self.resourceVersion = None
+                await asyncio.sleep(self.retryDelay)
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.run())
+        return self.task
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
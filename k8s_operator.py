@@ -1,7 +1,12 @@
+import asyncio
+import contextvars
 from base64 import b64encode
-from typing import List, Optional, cast
+from copy import deepcopy
+from os import getenv
+from typing import Callable, List, Optional, Tuple, Union, cast
 
 from pydantic.fields import Field
+from pydantic.main import BaseModel
 from resources.ConfigMap import ConfigMap
 
 from resources.Deployment import (
@@ -20,17 +25,27 @@ from resources.FRPClient import FRPClient
 from resources.FRPClientEndpoint import FRPClientEndpointModel
 from resources.FRPServer import FRPServerSpec, FRPServer, FRPServerToken
 import kopf
+import prometheus_client
 from resources.Namespace import Namespace
+from resources.Service import Service
 from resources.common import Selector, TemplateMetadata
 
 from resources.resource import ObjectMeta
 from pydantic import validate_arguments
 
-from resources.secret import Secret, SecretData, TokenSecret, TokenSecretData
+from resources.secret import (
+    Secret,
+    SecretData,
+    TokenSecret,
+    TokenSecretData,
+    secret_cache,
+)
 
 import secrets
-import hashlib
 import apiserver
+from context import asyncApi
+from metrics import RENDER_DURATION, timed
+from profiling import profiled
 
 
 class FRPSSecretConfig(SecretData):
@@ -49,40 +64,42 @@ def configure(settings: kopf.OperatorSettings, **_):
     )
 
 
+@kopf.on.startup()  # type: ignore
+async def prime_apiserver(**_):
+    if apiserver.MODE == "embedded":
+        await apiserver.prime()
+    else:
+        # no apiserver in this process to expose /metrics
+        prometheus_client.start_http_server(int(getenv("METRICS_PORT", 9090)))
+
+
+@kopf.on.cleanup()  # type: ignore
+async def close_kube_api(**_):
+    await asyncApi.close()
+
+
 @kopf.on.create("frp.nonamestudio.me/v1", "FRPServer")
 @kopf.on.field("frp.nonamestudio.me/v1", "FRPServer", field="spec.token")  # type: ignore
+@timed
+@profiled()
 @validate_arguments
-def ensure_frp_token(body: FRPServer, new: Optional[FRPServerToken], **kw):
+async def ensure_frp_token(body: FRPServer, new: Optional[FRPServerToken], **kw):
     if new is not None and new.secret:
         return
     token_name = f"frps-{body.metadata.name}-token"
 
     with body.owner():
         token = secrets.token_urlsafe()
-        TokenSecret(
+        await TokenSecret(
             data=TokenSecretData(token=token),
             metadata=ObjectMeta(
                 name=token_name,
                 namespace=body.metadata.namespace,
             ),
-        ).create()
+        ).create_async()
 
     body.spec.token = FRPServerToken(secret=token_name)
-    body.update()
-
-
-@kopf.on.update("frp.nonamestudio.me/v1", "FRPServer")  # type: ignore
-@kopf.on.create("frp.nonamestudio.me/v1", "FRPServer")  # type: ignore
-@validate_arguments
-def create_frp_server_secret(body: FRPServer, **kw):
-    with body.owner():
-        Secret(
-            metadata=ObjectMeta(
-                name=f"frps-{body.metadata.name}-config",
-                namespace=body.metadata.namespace,
-            ),
-            data=FRPSSecretConfig.parse_obj({"frps.ini": body.config()}),
-        ).upsert()
+    await body.update_async()
 
 
 def get_frpserver_clients_ports(body: FRPServer):
@@ -158,65 +175,43 @@ def get_frpclient_dashboard_ports(body: FRPClient):
     return ports
 
 
-@kopf.on.field("frp.nonamestudio.me/v1", "FRPServer", field="spec.service")  # type: ignore
-@kopf.on.create("frp.nonamestudio.me/v1", "FRPServer")  # type: ignore
-@validate_arguments
-def create_frp_server_clients_service(body: FRPServer, **kw):
-    with body.owner():
-        ports: List[PodContainerPort] = get_frpserver_clients_ports(body)
-        udp = []
-        tcp = []
-        for port in ports:
-            if port.protocol == "TCP":
-                tcp.append(port)
-            else:
-                udp.append(port)
-        if not ports:
-            return
-        if udp:
+def frp_server_services(body: FRPServer) -> List[Service]:
+    services = []
+    namespace = cast(str, body.metadata.namespace)
+    selector = get_frpserver_deploy_labels(body)
+
+    ports: List[PodContainerPort] = get_frpserver_clients_ports(body)
+    udp = [port for port in ports if port.protocol != "TCP"]
+    tcp = [port for port in ports if port.protocol == "TCP"]
+    if udp:
+        services.append(
             body.spec.service.forPorts(
-                udp,
-                get_frpserver_deploy_labels(body),
-                cast(str, body.metadata.namespace),
-                f"frps-{body.metadata.name}-udp",
-            ).upsert()
-        if tcp:
+                udp, selector, namespace, f"frps-{body.metadata.name}-udp"
+            )
+        )
+    if tcp:
+        services.append(
             body.spec.service.forPorts(
-                tcp,
-                get_frpserver_deploy_labels(body),
-                cast(str, body.metadata.namespace),
-                f"frps-{body.metadata.name}-tcp",
-            ).upsert()
-
+                tcp, selector, namespace, f"frps-{body.metadata.name}-tcp"
+            )
+        )
 
-@kopf.on.field("frp.nonamestudio.me/v1", "FRPServer", field="spec.dashboard.service")  # type: ignore
-@kopf.on.create("frp.nonamestudio.me/v1", "FRPServer")  # type: ignore
-@validate_arguments
-def create_frp_server_dashboard_service(body: FRPServer, **kw):
-    with body.owner():
-        ports: List[PodContainerPort] = get_frpserver_dashboard_ports(body)
-        if ports and body.spec.dashboard:
+    ports = get_frpserver_dashboard_ports(body)
+    if ports and body.spec.dashboard:
+        services.append(
             body.spec.dashboard.service.forPorts(
-                ports,
-                get_frpserver_deploy_labels(body),
-                cast(str, body.metadata.namespace),
-                f"frps-{body.metadata.name}-dashboard",
-            ).upsert()
-
+                ports, selector, namespace, f"frps-{body.metadata.name}-dashboard"
+            )
+        )
 
-@kopf.on.field("frp.nonamestudio.me/v1", "FRPServer", field="spec.vhost.service")  # type: ignore
-@kopf.on.create("frp.nonamestudio.me/v1", "FRPServer")  # type: ignore
-@validate_arguments
-def create_frp_server_vhost_service(body: FRPServer, **kw):
-    with body.owner():
-        ports: List[PodContainerPort] = get_frpserver_vhost_ports(body)
-        if ports and body.spec.vhost:
+    ports = get_frpserver_vhost_ports(body)
+    if ports and body.spec.vhost:
+        services.append(
             body.spec.vhost.service.forPorts(
-                ports,
-                get_frpserver_deploy_labels(body),
-                cast(str, body.metadata.namespace),
-                f"frps-{body.metadata.name}-vhost",
-            ).upsert()
+                ports, selector, namespace, f"frps-{body.metadata.name}-vhost"
+            )
+        )
+    return services
 
 
 def get_frpserver_deploy_labels(body: FRPServer):
@@ -233,180 +228,325 @@ def get_frpclient_deploy_labels(body: FRPClient):
     }
 
 
-@kopf.on.update("frp.nonamestudio.me/v1", "FRPServer")  # type: ignore
-@kopf.on.create("frp.nonamestudio.me/v1", "FRPServer")  # type: ignore
-@validate_arguments
-def create_frp_server_deploy(body: FRPServer, **kw):
-    with body.owner():
-        labels = get_frpserver_deploy_labels(body)
-        labels.update(
-            {
-                "frp.nonamestudio.me/config-md5": hashlib.md5(
-                    body.config().encode()
-                ).hexdigest()
-            }
-        )
-        ports = (
-            get_frpserver_clients_ports(body)
-            + get_frpserver_vhost_ports(body)
-            + get_frpserver_dashboard_ports(body)
-        )
-        Deployment(
-            metadata=ObjectMeta(
-                name=f"frps-{body.metadata.name}", namespace=body.metadata.namespace
-            ),
-            spec=DeploymentSpec(
-                template=DeploymentTemplate(
-                    metadata=TemplateMetadata(labels=labels),
-                    spec=DeploymentTemplateSpec(
-                        containers=[
-                            PodContainer(
-                                name="frp-server",
-                                image=body.spec.image,
-                                ports=ports,
-                                volumeMounts=[
-                                    PodContainerVolumeMount(
-                                        name="config", mountPath="/etc/frp"
-                                    ),
-                                ],
-                            )
-                        ],
-                        volumes=[
-                            PodVolume(
-                                secret=PodVolumeSecret(
-                                    secretName=f"frps-{body.metadata.name}-config"
+class RenderedConfig(BaseModel):
+    """
+    Config of an FRPServer/FRPClient and the children derived from it
+    """
+
+    config: str
+    md5: str
+    secret: Secret
+    deployment: Deployment
+    services: List[Service]
+
+
+async def render(
+    body: Union[FRPServer, FRPClient],
+    build: Callable[[str, str], Tuple[Secret, Deployment, List[Service]]],
+) -> RenderedConfig:
+    # secrets missing from secret_cache are fetched with blocking requests, keep
+    # them off the event loop (which also serves the embedded apiserver)
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        None, context.run, render_sync, body, build
+    )
+
+
+def render_sync(
+    body: Union[FRPServer, FRPClient],
+    build: Callable[[str, str], Tuple[Secret, Deployment, List[Service]]],
+) -> RenderedConfig:
+    with RENDER_DURATION.labels(body.kind).time():
+        iniConfig = body.iniConfig()
+        config = iniConfig.render()
+        md5 = iniConfig.hash()
+        with body.owner():
+            secret, deployment, services = build(config, md5)
+    return RenderedConfig(
+        config=config,
+        md5=md5,
+        secret=secret,
+        deployment=deployment,
+        services=services,
+    )
+
+
+async def reconcile(rendered: RenderedConfig):
+    """
+    Apply the rendered children: Services and the Secret concurrently, the
+    Deployment as soon as the Secret it mounts is in place
+    """
+
+    async def secret_then_deployment():
+        await rendered.secret.apply_async()
+        await rendered.deployment.apply_async()
+
+    await asyncio.gather(
+        secret_then_deployment(),
+        *(service.apply_async() for service in rendered.services),
+    )
+
+
+async def render_frp_server(body: FRPServer):
+    return await render(
+        body,
+        lambda config, md5: (
+            frp_server_secret(body, config),
+            frp_server_deployment(body, md5),
+            frp_server_services(body),
+        ),
+    )
+
+
+def frp_server_secret(body: FRPServer, config: str):
+    return Secret(
+        metadata=ObjectMeta(
+            name=f"frps-{body.metadata.name}-config",
+            namespace=body.metadata.namespace,
+        ),
+        data=FRPSSecretConfig.parse_obj({"frps.ini": config}),
+    )
+
+
+def frp_server_deployment(body: FRPServer, md5: str):
+    labels = get_frpserver_deploy_labels(body)
+    labels.update({"frp.nonamestudio.me/config-md5": md5})
+    ports = (
+        get_frpserver_clients_ports(body)
+        + get_frpserver_vhost_ports(body)
+        + get_frpserver_dashboard_ports(body)
+    )
+    return Deployment(
+        metadata=ObjectMeta(
+            name=f"frps-{body.metadata.name}", namespace=body.metadata.namespace
+        ),
+        spec=DeploymentSpec(
+            template=DeploymentTemplate(
+                metadata=TemplateMetadata(labels=labels),
+                spec=DeploymentTemplateSpec(
+                    containers=[
+                        PodContainer(
+                            name="frp-server",
+                            image=body.spec.image,
+                            ports=ports,
+                            volumeMounts=[
+                                PodContainerVolumeMount(
+                                    name="config", mountPath="/etc/frp"
                                 ),
-                                name="config",
+                            ],
+                        )
+                    ],
+                    volumes=[
+                        PodVolume(
+                            secret=PodVolumeSecret(
+                                secretName=f"frps-{body.metadata.name}-config"
                             ),
-                        ],
-                    ),
+                            name="config",
+                        ),
+                    ],
                 ),
-                selector=Selector(matchLabels=get_frpserver_deploy_labels(body)),
             ),
-        ).upsert()
+            selector=Selector(matchLabels=get_frpserver_deploy_labels(body)),
+        ),
+    )
 
 
-@kopf.on.update("frp.nonamestudio.me/v1", "FRPClient")  # type: ignore
-@kopf.on.create("frp.nonamestudio.me/v1", "FRPClient")  # type: ignore
-@validate_arguments
-def create_frp_client_secret(body: FRPClient, **kw):
-    with body.owner():
-        Secret(
-            metadata=ObjectMeta(
-                name=f"frpc-{body.metadata.name}-config",
-                namespace=body.metadata.namespace,
-            ),
-            data=FRPCSecretConfig.parse_obj({"frpc.ini": body.config()}),
-        ).upsert()
+@kopf.on.update("frp.nonamestudio.me/v1", "FRPServer")  # type: ignore
+@kopf.on.create("frp.nonamestudio.me/v1", "FRPServer")  # type: ignore
+@timed
+@profiled()
+@validate_arguments(config=dict(arbitrary_types_allowed=True))
+async def reconcile_frp_server(body: FRPServer, **kw):
+    await reconcile(await render_frp_server(body))
+
+
+async def render_frp_client(body: FRPClient):
+    return await render(
+        body,
+        lambda config, md5: (
+            frp_client_secret(body, config),
+            frp_client_deployment(body, md5),
+            [],
+        ),
+    )
 
 
-@kopf.on.update("frp.nonamestudio.me/v1", "FRPClient")  # type: ignore
-@kopf.on.create("frp.nonamestudio.me/v1", "FRPClient")  # type: ignore
-@validate_arguments
-def create_frp_client_deploy(body: FRPClient, **kw):
-    with body.owner():
-        labels = get_frpclient_deploy_labels(body)
-        labels.update(
-            {
-                "frp.nonamestudio.me/config-md5": hashlib.md5(
-                    body.config().encode()
-                ).hexdigest()
-            }
-        )
-        ports = get_frpclient_dashboard_ports(body)
-        assert body.metadata.namespace
+def frp_client_secret(body: FRPClient, config: str):
+    return Secret(
+        metadata=ObjectMeta(
+            name=f"frpc-{body.metadata.name}-config",
+            namespace=body.metadata.namespace,
+        ),
+        data=FRPCSecretConfig.parse_obj({"frpc.ini": config}),
+    )
 
-        Deployment(
-            metadata=ObjectMeta(
-                name=f"frpc-{body.metadata.name}", namespace=body.metadata.namespace
-            ),
-            spec=DeploymentSpec(
-                template=DeploymentTemplate(
-                    metadata=TemplateMetadata(labels=labels),
-                    spec=DeploymentTemplateSpec(
-                        containers=[
-                            PodContainer(
-                                name="frp-server",
-                                image=body.spec.image,
-                                ports=ports,
-                                volumeMounts=[
-                                    PodContainerVolumeMount(
-                                        name="config", mountPath="/etc/frp"
-                                    ),
-                                ],
-                            ),
-                            PodContainer(
-                                name="sidecar",
-                                image=body.spec.sidecarImage,
-                                ports=ports,
-                                command=["python", "sidecar.py"],
-                                volumeMounts=[
-                                    PodContainerVolumeMount(
-                                        name="default-config",
-                                        mountPath="/config/default",
-                                    ),
-                                    PodContainerVolumeMount(
-                                        name="config", mountPath="/config/frp"
-                                    ),
-                                ],
-                                env=[
-                                    PodContainerEnv(
-                                        name="NAME", value=body.metadata.name
-                                    ),
-                                    PodContainerEnv(
-                                        name="NAMESPACE", value=body.metadata.namespace
-                                    ),
-                                ],
-                            ),
-                        ],
-                        volumes=[
-                            PodVolume(
-                                secret=PodVolumeSecret(
-                                    secretName=f"frpc-{body.metadata.name}-config"
+
+def frp_client_deployment(body: FRPClient, md5: str):
+    labels = get_frpclient_deploy_labels(body)
+    labels.update({"frp.nonamestudio.me/config-md5": md5})
+    ports = get_frpclient_dashboard_ports(body)
+    assert body.metadata.namespace
+
+    return Deployment(
+        metadata=ObjectMeta(
+            name=f"frpc-{body.metadata.name}", namespace=body.metadata.namespace
+        ),
+        spec=DeploymentSpec(
+            template=DeploymentTemplate(
+                metadata=TemplateMetadata(labels=labels),
+                spec=DeploymentTemplateSpec(
+                    containers=[
+                        PodContainer(
+                            name="frp-server",
+                            image=body.spec.image,
+                            ports=ports,
+                            volumeMounts=[
+                                PodContainerVolumeMount(
+                                    name="config", mountPath="/etc/frp"
                                 ),
-                                name="default-config",
-                            ),
-                            PodVolume(
-                                emptyDir={},
-                                name="config",
+                            ],
+                        ),
+                        PodContainer(
+                            name="sidecar",
+                            image=body.spec.sidecarImage,
+                            ports=ports,
+                            command=["python", "sidecar.py"],
+                            volumeMounts=[
+                                PodContainerVolumeMount(
+                                    name="default-config",
+                                    mountPath="/config/default",
+                                ),
+                                PodContainerVolumeMount(
+                                    name="config", mountPath="/config/frp"
+                                ),
+                            ],
+                            env=[
+                                PodContainerEnv(name="NAME", value=body.metadata.name),
+                                PodContainerEnv(
+                                    name="NAMESPACE", value=body.metadata.namespace
+                                ),
+                            ],
+                        ),
+                    ],
+                    volumes=[
+                        PodVolume(
+                            secret=PodVolumeSecret(
+                                secretName=f"frpc-{body.metadata.name}-config"
                             ),
-                        ],
-                    ),
+                            name="default-config",
+                        ),
+                        PodVolume(
+                            emptyDir={},
+                            name="config",
+                        ),
+                    ],
                 ),
-                selector=Selector(matchLabels=get_frpclient_deploy_labels(body)),
             ),
-        ).upsert()
+            selector=Selector(matchLabels=get_frpclient_deploy_labels(body)),
+        ),
+    )
 
 
-@kopf.on.update("frp.nonamestudio.me/v1", "FRPClientEndpoint")  # type: ignore
-@kopf.on.create("frp.nonamestudio.me/v1", "FRPClientEndpoint")  # type: ignore
-@kopf.on.resume("frp.nonamestudio.me/v1", "FRPClientEndpoint")  # type: ignore
-@validate_arguments
-def update_endpoints(body: FRPClientEndpointModel, **kw):
-    if body.metadata.namespace:
-        apiserver.endpoints.setdefault(body.metadata.namespace, {}).update(
-            {body.metadata.name: body}
-        )
+@kopf.on.update("frp.nonamestudio.me/v1", "FRPClient")  # type: ignore
+@kopf.on.create("frp.nonamestudio.me/v1", "FRPClient")  # type: ignore
+@timed
+@profiled()
+@validate_arguments(config=dict(arbitrary_types_allowed=True))
+async def reconcile_frp_client(body: FRPClient, **kw):
+    await reconcile(await render_frp_client(body))
 
 
-@kopf.on.delete("frp.nonamestudio.me/v1", "FRPClientEndpoint")  # type: ignore
-@validate_arguments
-def delete_endpoint(body: FRPClientEndpointModel, **kw):
-    if body.metadata.namespace:
-        apiserver.endpoints.setdefault(body.metadata.namespace, {}).pop(
-            body.metadata.name, None
-        )
+@kopf.on.event("frp.nonamestudio.me/v1", "FRPServer")  # type: ignore
+@timed
+@profiled()
+async def cache_frp_server(event: kopf.RawEvent, **kw):
+    FRPServer.cache.apply(event)
+    secret_cache.referenceBy(FRPServer, event)
 
 
-@kopf.on.create("namespace")  # type: ignore
-@kopf.on.resume("namespace")  # type: ignore
-@validate_arguments
-def update_namespaces(body: Namespace, **kw):
-    apiserver.namespaces.setdefault(body.metadata.name, body)
+@kopf.on.event("frp.nonamestudio.me/v1", "FRPClient")  # type: ignore
+@timed
+@profiled()
+async def cache_frp_client(event: kopf.RawEvent, **kw):
+    FRPClient.cache.apply(event)
+    secret_cache.referenceBy(FRPClient, event)
+    if event["type"] == "DELETED":
+        metadata = event["object"]["metadata"]
+        apiserver.services.forget(metadata["namespace"], metadata["name"])
 
 
-@kopf.on.delete("namespace", optional=True)  # type: ignore
-@validate_arguments
-def delete_namespaces(body: Namespace, **kw):
-    if body.metadata.namespace:
-        apiserver.namespaces.pop(body.metadata.name, None)
+def is_referenced_secret(name: str, namespace: str, **_):
+    return secret_cache.isReferenced(namespace, name)
+
+
+@kopf.on.event("v1", "secrets", when=is_referenced_secret)  # type: ignore
+@timed
+@profiled()
+async def cache_secret(event: kopf.RawEvent, name: str, namespace: str, **kw):
+    if not secret_cache.apply(event):
+        return
+    # a referenced secret was rotated: reconcile its referrers right here, their
+    # own update handlers do not fire as the objects themselves did not change
+    renderers = {
+        FRPServer.kind: (FRPServer, render_frp_server),
+        FRPClient.kind: (FRPClient, render_frp_client),
+    }
+
+    async def rerender(referrer):
+        kind, referrerNamespace, referrerName = referrer
+        resource, renderer = renderers[kind]
+        obj = resource.cache.get(referrerNamespace, referrerName)
+        if obj is None:
+            return
+        await reconcile(await renderer(resource.from_obj(deepcopy(obj))))
+
+    await asyncio.gather(
+        *(rerender(referrer) for referrer in secret_cache.referrers(namespace, name))
+    )
+
+
+# Endpoints, namespaces and selectors only feed the embedded apiserver. With an
+# external one nothing here would serve them, and the endpoint delete handler
+# would put a finalizer on every FRPClientEndpoint for nothing.
+if apiserver.MODE == "embedded":
+
+    @kopf.on.field("frp.nonamestudio.me/v1", "FRPClient", field="spec.selector")  # type: ignore
+    @kopf.on.field("frp.nonamestudio.me/v1", "FRPClient", field="spec.namespaceSelector")  # type: ignore
+    @timed
+    @profiled()
+    async def notify_frp_client_selector(namespace: str, name: str, **kw):
+        apiserver.notify_frp_client_changed(namespace, name)
+
+    @kopf.on.update("frp.nonamestudio.me/v1", "FRPClientEndpoint")  # type: ignore
+    @kopf.on.create("frp.nonamestudio.me/v1", "FRPClientEndpoint")  # type: ignore
+    @kopf.on.resume("frp.nonamestudio.me/v1", "FRPClientEndpoint")  # type: ignore
+    @timed
+    @profiled()
+    @validate_arguments
+    async def update_endpoints(body: FRPClientEndpointModel, **kw):
+        if body.metadata.namespace:
+            apiserver.store_endpoint(body)
+
+    @kopf.on.delete("frp.nonamestudio.me/v1", "FRPClientEndpoint")  # type: ignore
+    @timed
+    @profiled()
+    @validate_arguments
+    async def delete_endpoint(body: FRPClientEndpointModel, **kw):
+        if body.metadata.namespace:
+            apiserver.remove_endpoint(body.metadata.namespace, body.metadata.name)
+
+    @kopf.on.create("namespace")  # type: ignore
+    @kopf.on.resume("namespace")  # type: ignore
+    @kopf.on.field("namespace", field="metadata.labels")  # type: ignore
+    @timed
+    @profiled()
+    @validate_arguments
+    async def update_namespaces(body: Namespace, **kw):
+        apiserver.store_namespace(body)
+
+    @kopf.on.delete("namespace", optional=True)  # type: ignore
+    @timed
+    @profiled()
+    @validate_arguments
+    async def delete_namespaces(body: Namespace, **kw):
+        apiserver.remove_namespace(body.metadata.name)
@@ -0,0 +1,110 @@
+import functools
+import inspect
+import time
+import typing
+from urllib.parse import urlparse
+
+import requests
+from prometheus_client import Counter, Gauge, Histogram
+
+HANDLER_DURATION = Histogram(
+    "frp_operator_handler_duration_seconds",
+    "Duration of kopf handlers",
+    ["handler"],
+)
+HANDLER_ERRORS = Counter(
+    "frp_operator_handler_errors_total",
+    "Exceptions raised by kopf handlers",
+    ["handler"],
+)
+KUBE_API_DURATION = Histogram(
+    "frp_operator_kube_api_request_duration_seconds",
+    "Duration of Kubernetes API requests",
+    ["verb", "resource", "code"],
+)
+RENDER_DURATION = Histogram(
+    "frp_operator_render_duration_seconds",
+    "Time spent rendering frp configs",
+    ["kind"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+)
+INDEX_SIZE = Gauge(
+    "frp_operator_index_size",
+    "Number of objects held by the apiserver indexes",
+    ["index"],
+)
+REQUEST_DURATION = Histogram(
+    "frp_operator_http_request_duration_seconds",
+    "Duration of apiserver requests, long-polls included",
+    ["method", "route", "status"],
+)
+RESPONSE_SIZE = Histogram(
+    "frp_operator_http_response_size_bytes",
+    "Body size of apiserver responses",
+    ["route"],
+    buckets=(100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000),
+)
+
+
+def kubeResource(url: str):
+    """
+    Resource name of a Kubernetes API url, e.g. secrets for
+    /api/v1/namespaces/default/secrets/name
+    """
+    bits = urlparse(url).path.strip("/").split("/")
+    # drop api/v1 or apis/<group>/<version>
+    bits = bits[2:] if bits[0] == "api" else bits[3:]
+    if len(bits) > 2 and bits[0] == "namespaces":
+        bits = bits[2:]
+    return bits[0] if bits else ""
+
+
+def observe_kube_request(verb: str, url: str, code: int, seconds: float):
+    KUBE_API_DURATION.labels(verb, kubeResource(url), str(code)).observe(seconds)
+
+
+def observe_kube_response(response: requests.Response, *args, **kwargs):
+    """
+    requests response hook for the pykube session
+    """
+    observe_kube_request(
+        response.request.method or "",
+        response.url,
+        response.status_code,
+        response.elapsed.total_seconds(),
+    )
+
+
+def timed(fn: typing.Callable):
+    """
+    Record duration and failures of a kopf handler, sync or async
+    """
+    name = fn.__name__
+
+    if inspect.iscoroutinefunction(inspect.unwrap(fn)):
+
+        @functools.wraps(fn)
+        async def async_wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            except Exception:
+                HANDLER_ERRORS.labels(name).inc()
+                raise
+            finally:
+                HANDLER_DURATION.labels(name).observe(time.perf_counter() - started)
+
+        return async_wrapper
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            HANDLER_ERRORS.labels(name).inc()
+            raise
+        finally:
+            HANDLER_DURATION.labels(name).observe(time.perf_counter() - started)
+
+    return wrapper
@@ -0,0 +1,125 @@
+import cProfile
+import functools
+import inspect
+import io
+import logging
+import os
+import pstats
+import random
+import tempfile
+import threading
+import time
+import typing
+from os import getenv
+
+logger = logging.getLogger(__name__)
+
+# Profile every call of objects carrying this annotation with value "true"
+PROFILE_ANNOTATION = "frp.nonamestudio.me/profile"
+# Or profile a sample of all calls, 1% unless PROFILE_SAMPLE_RATE says otherwise
+PROFILE_ALL = getenv("PROFILE", "").lower() in ("1", "true", "yes")
+PROFILE_SAMPLE_RATE = float(getenv("PROFILE_SAMPLE_RATE", 0.01))
+PROFILE_DIR = getenv(
+    "PROFILE_DIR", os.path.join(tempfile.gettempdir(), "frp-operator-profiles")
+)
+PROFILE_TOP = int(getenv("PROFILE_TOP", 20))
+
+# cProfile hooks into the thread it runs in, one profile per thread at a time
+running = threading.local()
+
+
+def _metadata(kwargs: dict, kind) -> typing.Mapping:
+    obj = kwargs.get("body")
+    if obj is None and kwargs.get("event") is not None:
+        obj = kwargs["event"].get("object")
+    if obj is None and kind is not None and "name" in kwargs:
+        obj = kind.cache.get(kwargs.get("namespace"), kwargs["name"])
+    if obj is None:
+        return {}
+    return obj.get("metadata") or {}
+
+
+def _selected(metadata: typing.Mapping):
+    annotations = metadata.get("annotations") or {}
+    if annotations.get(PROFILE_ANNOTATION, "").lower() == "true":
+        return True
+    return PROFILE_ALL and random.random() < PROFILE_SAMPLE_RATE
+
+
+def _start():
+    if getattr(running, "profile", None) is not None:
+        return None
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        # another profiler is active in this process
+        return None
+    running.profile = profile
+    return profile
+
+
+def _stop(profile: cProfile.Profile, name: str, metadata: typing.Mapping, seconds):
+    profile.disable()
+    running.profile = None
+    target = f"{metadata.get('namespace', '')}/{metadata.get('name', '')}"
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(
+        PROFILE_DIR,
+        f"{name}-{target.replace('/', '-').strip('-')}-{time.time_ns()}.prof",
+    )
+    profile.dump_stats(path)
+    top = io.StringIO()
+    pstats.Stats(profile, stream=top).sort_stats("cumulative").print_stats(PROFILE_TOP)
+    logger.info(
+        "Profiled %s for %s in %.1fms, written to %s\n%s",
+        name,
+        target,
+        seconds * 1000,
+        path,
+        top.getvalue(),
+    )
+
+
+def profiled(kind=None):
+    """
+    Profile selected calls of a kopf handler or apiserver route with cProfile.
+    Handlers find the object in their body/event argument, routes look up
+    namespace/name in the cache of kind. Profiles of coroutines include
+    whatever else ran on the event loop while they were suspended.
+    """
+
+    def decorator(fn: typing.Callable):
+        name = fn.__name__
+
+        if inspect.iscoroutinefunction(inspect.unwrap(fn)):
+
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                metadata = _metadata(kwargs, kind)
+                profile = _start() if _selected(metadata) else None
+                if profile is None:
+                    return await fn(*args, **kwargs)
+                started = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    _stop(profile, name, metadata, time.perf_counter() - started)
+
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            metadata = _metadata(kwargs, kind)
+            profile = _start() if _selected(metadata) else None
+            if profile is None:
+                return fn(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                _stop(profile, name, metadata, time.perf_counter() - started)
+
+        return wrapper
+
+    return decorator
@@ -2,6 +2,7 @@ from typing import Optional
 from pydantic.main import BaseModel
 from resources.Service import EmbedService
 from resources.common import Labels
+from resources.ini import IniConfig
 from resources.resource import Resource
 from resources.secret import BasicAuthSecret, TokenSecret
 
@@ -30,6 +31,12 @@ class FRPClientSpec(BaseModel):
     target: FRPClientTarget
     dashboard: Optional[FRPClientDashboard] = None
 
+    def secretNames(self):
+        names = [self.target.token.secret]
+        if self.dashboard:
+            names.append(self.dashboard.credentials)
+        return names
+
 
 class FRPClient(
     Resource,
@@ -39,33 +46,46 @@ class FRPClient(
 ):
     spec: FRPClientSpec
 
-    def config(self):
-        token_secret = TokenSecret.get(
+    def iniConfig(self):
+        token_secret = TokenSecret.get_cached(
             self.spec.target.token.secret, self.metadata.namespace
         ).decode()
 
-        config = "[common]\n"
+        config = IniConfig()
+        common = config.section("common")
 
-        config += f"token = {token_secret.data.token}\n"
-        config += f"server_addr = {self.spec.target.host}\n"
-        config += f"server_port = {self.spec.target.port}\n"
+        # the sidecar reads token and admin_* by line, keep their positions
+        common.set("token", token_secret.data.token)
+        common.set("server_addr", self.spec.target.host)
+        common.set("server_port", self.spec.target.port)
 
         if self.spec.dashboard:
-            dashboard_secret = BasicAuthSecret.get(
+            dashboard_secret = BasicAuthSecret.get_cached(
                 self.spec.dashboard.credentials, self.metadata.namespace
             ).decode()
-            config += f"admin_addr = 0.0.0.0\n"
-            config += f"admin_port = {self.spec.dashboard.port}\n"
-            config += f"admin_user = {dashboard_secret.data.username}\n"
-            config += f"admin_pwd = {dashboard_secret.data.password}\n"
+            common.update(
+                {
+                    "admin_addr": "0.0.0.0",
+                    "admin_port": self.spec.dashboard.port,
+                    "admin_user": dashboard_secret.data.username,
+                    "admin_pwd": dashboard_secret.data.password,
+                }
+            )
         else:
-            config += f"admin_addr = 127.0.0.1\n"
-            config += f"admin_port = 7400\n"
-            config += f"admin_user = sidecar\n"
-            config += f"admin_pwd = pwd\n"
-
-        config += f"user = k8s-{self.metadata.namespace}-{self.metadata.name}\n"
-        config += f"meta_k8s_ns = {self.metadata.namespace}\n"
-        config += f"meta_k8s_name = {self.metadata.name}\n"
+            common.update(
+                {
+                    "admin_addr": "127.0.0.1",
+                    "admin_port": 7400,
+                    "admin_user": "sidecar",
+                    "admin_pwd": "pwd",
+                }
+            )
+
+        common.set("user", f"k8s-{self.metadata.namespace}-{self.metadata.name}")
+        common.set("meta_k8s_ns", self.metadata.namespace)
+        common.set("meta_k8s_name", self.metadata.name)
 
         return config
+
+    def config(self):
+        return self.iniConfig().render()
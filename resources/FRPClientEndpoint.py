@@ -2,6 +2,7 @@ from enum import Enum
 from typing import Dict, Literal, Optional, Union, List
 from pydantic.main import BaseModel
 
+from resources.ini import IniConfig
 from resources.resource import ObjectMeta, Resource
 
 
@@ -39,34 +40,43 @@ class FRPClientEndpointSpecBase(BaseModel):
 
     additionalConfig: str = ""
 
-    def config(self, name: str):
-        config = f"[{name}]\n"
-        config += f"type = {self.type}\n"
-        config += f"local_ip = {self.local.host}\n"
-        config += f"local_port = {self.local.port}\n"
-        config += f"use_encryption = {self.encryption}\n"
-        config += f"use_compression = {self.compression}\n"
+    def iniConfig(self, name: str):
+        config = IniConfig()
+        section = config.section(name)
+        section.update(
+            {
+                "type": self.type,
+                "local_ip": self.local.host,
+                "local_port": self.local.port,
+                "use_encryption": self.encryption,
+                "use_compression": self.compression,
+            }
+        )
 
         if self.group:
-            config += f"group = {self.group.name}\n"
-            config += f"group_key = {self.group.key}\n"
+            section.set("group", self.group.name)
+            section.set("group_key", self.group.key)
 
         if self.bandwidthLimit:
-            config += f"bandwidth_limit = {self.bandwidthLimit}\n"
+            section.set("bandwidth_limit", self.bandwidthLimit)
 
-        config += f"{self.additionalConfig}\n"
         return config
 
+    def config(self, name: str):
+        config = self.iniConfig(name)
+        # additionalConfig goes last so it can override generated options
+        config.merge(IniConfig.parse(self.additionalConfig, default=name))
+        return config.render()
+
 
 class FRPClientEndpointSpecL4(FRPClientEndpointSpecBase):
     type: Union[Literal[FRPClientEndpointType.udp], Literal[FRPClientEndpointType.tcp]]
 
     remote: FRPClientEndpointRemote
 
-    def config(self, name: str):
-        config = super().config(name)
-        config += f"remote_port = {self.remote.port}\n"
-
+    def iniConfig(self, name: str):
+        config = super().iniConfig(name)
+        config.section(name).set("remote_port", self.remote.port)
         return config
 
 
@@ -91,19 +101,16 @@ class FRPClientEndpointSpecHTTP(FRPClientEndpointSpecBase):
     ]
     http: FRPClientHttp
 
-    def config(self, name: str):
-        config = super().config(name)
-        if self.http.subdomain:
-            config += f"subdomain = {self.http.subdomain}\n"
-        if self.http.customDomains:
-            config += f"custom_domains = {','.join(self.http.customDomains)}\n"
-        if self.http.locations:
-            config += f"locations = {','.join(self.http.locations)}\n"
-        if self.http.hostHeaderRewrite:
-            config += f"host_header_rewrite = {self.http.hostHeaderRewrite}\n"
-
-        for header, value in self.http.headers.items():
-            config += f"header_{header} = {value}"
+    def iniConfig(self, name: str):
+        config = super().iniConfig(name)
+        section = config.section(name)
+        section.set("subdomain", self.http.subdomain or None)
+        section.set("custom_domains", self.http.customDomains or None)
+        section.set("locations", self.http.locations or None)
+        section.set("host_header_rewrite", self.http.hostHeaderRewrite or None)
+
+        for header in sorted(self.http.headers):
+            section.set(f"header_{header}", self.http.headers[header])
 
         return config
 
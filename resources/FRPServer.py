@@ -4,6 +4,7 @@ from pydantic import BaseModel
 from resources.Deployment import PodContainerPort
 from resources.Service import EmbedService
 from resources.common import Annotations, Labels
+from resources.ini import IniConfig, IniSection
 
 from resources.resource import Resource
 
@@ -39,12 +40,9 @@ class FRPServerPlugin(BaseModel):
     path: str = "/handler"
     ops: str
 
-    def config(self):
-        return (
-            f"[plugin.{self.name}]\n"
-            f"addr = {self.addr}:{self.port}\n"
-            f"path = {self.path}\n"
-            f"ops = {self.ops}\n"
+    def section(self):
+        return IniSection(name=f"plugin.{self.name}").update(
+            {"addr": f"{self.addr}:{self.port}", "path": self.path, "ops": self.ops}
         )
 
 
@@ -59,48 +57,59 @@ class FRPServerSpec(BaseModel):
     token: Optional[FRPServerToken] = None  # if none then auto generate
     service: EmbedService = EmbedService()
 
-    def config(self, namespace: str):
+    def secretNames(self):
+        names = []
+        if self.token and self.token.secret:
+            names.append(self.token.secret)
+        if self.dashboard:
+            names.append(self.dashboard.credentials)
+        return names
+
+    def iniConfig(self, namespace: str):
         if not self.token:
             raise ValueError("Token not specified")
 
-        token_secret = TokenSecret.get(self.token.secret, namespace).decode()
-
-        config = "[common]\n"
-
-        config += f"token = {token_secret.data.token}\n"
-
-        config += (
-            f"bind_addr = 0.0.0.0\n"
-            f"bind_port = {self.ports.tcp}\n"
-            f"bind_udp_port = {self.ports.udp}\n"
+        token_secret = TokenSecret.get_cached(self.token.secret, namespace).decode()
+
+        config = IniConfig()
+        common = config.section("common")
+        common.set("token", token_secret.data.token)
+        common.update(
+            {
+                "bind_addr": "0.0.0.0",
+                "bind_port": self.ports.tcp,
+                "bind_udp_port": self.ports.udp,
+            }
         )
 
         if self.ports.kcp:
-            config += f"kcp_bind_port = {self.ports.kcp}\n"
+            common.set("kcp_bind_port", self.ports.kcp)
 
         if self.vhost:
-            config += f"vhost_http_port = {self.vhost.http}\n"
-            if self.vhost.https:
-                config += f"vhost_https_port = {self.vhost.https}\n"
+            common.set("vhost_http_port", self.vhost.http)
+            common.set("vhost_https_port", self.vhost.https or None)
 
         if self.dashboard:
-            config += f"dashboard_port = {self.dashboard.port}\n"
-            dashboard_creds = BasicAuthSecret.get(
+            common.set("dashboard_port", self.dashboard.port)
+            dashboard_creds = BasicAuthSecret.get_cached(
                 self.dashboard.credentials, namespace
             ).decode()
-            config += f"dashboard_user = {dashboard_creds.data.username}\n"
-            config += f"dashboard_pwd = {dashboard_creds.data.password}\n"
+            common.set("dashboard_user", dashboard_creds.data.username)
+            common.set("dashboard_pwd", dashboard_creds.data.password)
 
-        config += f"enable_prometheus = {'true' if self.prometheus else 'false'}\n"
+        common.set("enable_prometheus", self.prometheus)
 
         if self.allowPorts:
-            config += f"allow_ports = {self.allowPorts}\n"
+            common.set("allow_ports", self.allowPorts)
 
         for plugin in self.plugins:
-            config += plugin.config()
+            config.sections.append(plugin.section())
 
         return config
 
+    def config(self, namespace: str):
+        return self.iniConfig(namespace).render()
+
 
 class FRPServer(
     Resource,
@@ -110,5 +119,8 @@ class FRPServer(
 ):
     spec: FRPServerSpec
 
+    def iniConfig(self):
+        return self.spec.iniConfig(self.metadata.namespace)  # type: ignore
+
     def config(self):
         return self.spec.config(self.metadata.namespace)  # type: ignore
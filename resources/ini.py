@@ -0,0 +1,105 @@
+import hashlib
+import logging
+from enum import Enum
+from typing import Any, Dict, List, Optional
+
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+
+def formatValue(value: Any) -> str:
+    """
+    Canonical ini spelling of a value, the same whatever python version or
+    model type produced it
+    """
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, Enum):
+        return formatValue(value.value)
+    if isinstance(value, (list, tuple)):
+        return ",".join(formatValue(item) for item in value)
+    return str(value)
+
+
+class IniSection(BaseModel):
+    name: str
+    options: Dict[str, str] = {}
+
+    def set(self, key: str, value: Any):
+        """
+        Set an option, None leaves it out. Options keep the order they were
+        first set in, setting a key again replaces its value in place
+        """
+        if value is not None:
+            self.options[key] = formatValue(value)
+        return self
+
+    def update(self, options: Dict[str, Any]):
+        for key, value in options.items():
+            self.set(key, value)
+        return self
+
+    def render(self):
+        config = f"[{self.name}]\n"
+        for key, value in self.options.items():
+            config += f"{key} = {value}\n"
+        return config
+
+    def hash(self):
+        return hashlib.md5(self.render().encode()).hexdigest()
+
+
+class IniConfig(BaseModel):
+    """
+    Sections of an frp ini file. [common] always comes first and the other
+    sections are sorted by name, so the same state renders to the same bytes
+    """
+
+    sections: List[IniSection] = []
+
+    def section(self, name: str):
+        for section in self.sections:
+            if section.name == name:
+                return section
+        section = IniSection(name=name)
+        self.sections.append(section)
+        return section
+
+    def merge(self, other: "IniConfig"):
+        for section in other.sections:
+            self.section(section.name).update(section.options)
+        return self
+
+    def ordered(self):
+        return sorted(
+            self.sections, key=lambda section: (section.name != "common", section.name)
+        )
+
+    def render(self):
+        return "\n".join(section.render() for section in self.ordered())
+
+    def hash(self):
+        return hashlib.md5(self.render().encode()).hexdigest()
+
+    @classmethod
+    def parse(cls, text: str, default: Optional[str] = None):
+        """
+        Parse ini text, options before the first section header go to default.
+        Lines that are no option or section header are logged and skipped.
+        """
+        config = cls()
+        current = config.section(default) if default is not None else None
+        for line in text.splitlines():
+            line = line.strip()
+            if not line or line.startswith(("#", ";")):
+                continue
+            if line.startswith("[") and line.endswith("]"):
+                current = config.section(line[1:-1].strip())
+                continue
+            key, sep, value = line.partition("=")
+            if not sep or not key.strip() or current is None:
+                logger.warning("Skipping invalid ini line: %s", line)
+                continue
+            current.set(key.strip(), value.strip())
+        return config
@@ -1,7 +1,12 @@
 from __future__ import annotations
+import asyncio
 import copy
+import hashlib
+import json
+import threading
+import time
 from inspect import getmro
-from typing import Annotated, Any, ClassVar, Dict, List, Optional, Type
+from typing import Annotated, Any, ClassVar, Dict, List, Mapping, Optional, Tuple, Type
 from pydantic import BaseModel, Field
 from pydantic.class_validators import validator
 from pydantic.fields import PrivateAttr
@@ -16,13 +21,90 @@ from pykube.objects import (
     object_factory as pykube_object_factory,
 )
 from pykube.query import Query, Table
-from context import kubeApi, ownerReferences
+from pykube.utils import obj_merge
+from context import asyncKubeApi, kubeApi, ownerReferences
 from contextlib import contextmanager
+from os import getenv
 
 from resources.common import Annotations, Labels, TemplateMetadata
 from copy import deepcopy
 
 DEFAULT = object()
+FIELD_MANAGER = "frp-operator"
+# managers of the create()/update() writes of releases before server-side apply,
+# named after pykube's user agent (or the one of requests)
+LEGACY_FIELD_MANAGERS = {"pykube-ng", "python-requests"}
+DESIRED_HASH_ANNOTATION = "frp.nonamestudio.me/desired-hash"
+
+# desired-state hashes last written by this process and when, keyed by
+# (apiVersion, kind, namespace, name). Records expire after APPLIED_HASH_TTL
+# seconds so children changed or deleted out of band are eventually re-applied.
+applied_hashes: Dict[Tuple[str, str, Optional[str], str], Tuple[str, float]] = {}
+APPLIED_HASH_TTL = float(getenv("APPLIED_HASH_TTL", 300))
+
+
+def contains(actual, desired) -> bool:
+    """
+    Whether actual holds every field of desired. Fields only actual has, e.g.
+    defaulted by the server, are ignored, as are unset or empty desired ones
+    """
+    if desired is None:
+        return True
+    if isinstance(desired, dict):
+        return isinstance(actual, dict) and all(
+            contains(actual[key], value) if key in actual else value in ({}, [], None)
+            for key, value in desired.items()
+        )
+    if isinstance(desired, list):
+        return (
+            isinstance(actual, list)
+            and len(actual) == len(desired)
+            and all(map(contains, actual, desired))
+        )
+    return actual == desired
+
+
+def merge_fields(target: dict, fields: dict):
+    for key, value in fields.items():
+        merge_fields(target.setdefault(key, {}), value)
+    return target
+
+
+def upgrade_managed_fields(managedFields: List[dict]) -> Optional[List[dict]]:
+    """
+    Move the fields of legacy Update managers to the FIELD_MANAGER Apply entry,
+    as client-go's csaupgrade does. Otherwise they would share the fields the
+    operator applies and keep those it stops applying. None if nothing to move
+    """
+    legacy = [
+        entry
+        for entry in managedFields
+        if entry.get("manager") in LEGACY_FIELD_MANAGERS
+        and entry.get("operation") == "Update"
+        and not entry.get("subresource")
+    ]
+    if not legacy:
+        return None
+    upgraded = [deepcopy(entry) for entry in managedFields if entry not in legacy]
+    for entry in upgraded:
+        if (
+            entry.get("manager") == FIELD_MANAGER
+            and entry.get("operation") == "Apply"
+            and not entry.get("subresource")
+        ):
+            applied = entry
+            break
+    else:
+        applied = {
+            key: value
+            for key, value in legacy[0].items()
+            if key in ("apiVersion", "fieldsType", "time")
+        }
+        applied.update(manager=FIELD_MANAGER, operation="Apply")
+        upgraded.append(applied)
+    for entry in legacy:
+        merge_fields(applied.setdefault("fieldsV1", {}), entry.get("fieldsV1") or {})
+    return upgraded
 
 
 class ModelQuery(object):
@@ -129,6 +211,9 @@ class ObjectFactoryCache(object):
     def __init__(self):
         self.data = {}
 
+    def __contains__(self, key):
+        return (kubeApi.get(), *key) in self.data
+
     def __call__(self, apiVersion, kind):
         args = (kubeApi.get(), apiVersion, kind)
         if self.data.get(args, None) is None:
@@ -140,6 +225,59 @@ class ObjectFactoryCache(object):
 
 object_factory = ObjectFactoryCache()
 
+
+class ObjectCache(object):
+    """
+    In-process informer-style store of raw objects of one kind, fed by watch events
+    """
+
+    data: Dict[Tuple[Optional[str], str], dict]
+    watched: bool
+
+    def __init__(self):
+        self.data = {}
+        self.watched = False
+        self.lock = threading.Lock()
+
+    def get(self, namespace: Optional[str], name: str) -> Optional[dict]:
+        return self.data.get((namespace, name))
+
+    def put(self, obj: Mapping, replace=True):
+        metadata = obj["metadata"]
+        key = (metadata.get("namespace"), metadata["name"])
+        with self.lock:
+            if replace or key not in self.data:
+                self.data[key] = deepcopy(dict(obj))
+
+    def discard(self, namespace: Optional[str], name: str):
+        with self.lock:
+            self.data.pop((namespace, name), None)
+
+    def apply(self, event: Mapping):
+        """
+        Apply a raw watch event ({"type": ..., "object": ...})
+        """
+        self.watched = True
+        obj = event["object"]
+        if event.get("type") == "DELETED":
+            self.discard(obj["metadata"].get("namespace"), obj["metadata"]["name"])
+        else:
+            self.put(obj)
+
+
+class ObjectCacheRegistry(object):
+    data: Dict[Tuple[str, str], ObjectCache]
+
+    def __init__(self):
+        self.data = {}
+
+    def __call__(self, apiVersion: str, kind: str) -> ObjectCache:
+        return self.data.setdefault((apiVersion, kind), ObjectCache())
+
+
+object_cache = ObjectCacheRegistry()
+
+
 # https://github.com/asteven/kopf/blob/53d82e5014a2c14e761d4efcce2f05bb3ed90590/kopf/resources.py#L10
 def dereference_schema(schema, definitions, parent=None, key=None):
     """Find and dereference objects in the given schema.
@@ -263,6 +401,7 @@ class Resource(BaseModel):
     _api = PrivateAttr()
 
     objects: ClassVar[ModelObjectManager] = ModelObjectManager()
+    cache: ClassVar[ObjectCache]
 
     apiVersion: ClassVar[str]
     kind: ClassVar[str]
@@ -302,6 +441,7 @@ class Resource(BaseModel):
         cls.objects.setCls(cls)
         cls.apiVersion = f"{cls.__group__}/{cls.__version__}".removeprefix("/")
         cls.kind = kind
+        cls.cache = object_cache(cls.apiVersion, kind)
         for key, field in cls.__fields__.items():
             try:
                 if issubclass(field.type_, Subresource):
@@ -351,9 +491,13 @@ class Resource(BaseModel):
         body["spec"]["versions"] = [version]
         return body
 
+    @classmethod
+    def from_obj(cls, obj: dict):
+        return cls.parse_obj(obj)
+
     @classmethod
     def from_pykube(cls, obj: APIObject):
-        self = cls.parse_obj(obj.obj)
+        self = cls.from_obj(obj.obj)
         self._pykube_obj = obj
         return self
 
@@ -367,11 +511,160 @@ class Resource(BaseModel):
 
         return cls.from_pykube(obj)
 
+    @classmethod
+    def get_cached(cls, name, namespace=None):
+        """
+        Get object from the watch-fed cache, falls back to get() on cache miss
+        """
+        obj = cls.cache.get(namespace, name)
+        if obj is None:
+            self = cls.get(name, namespace)
+            if cls.cache.watched:
+                cls.cache.put(self._get_pykube_obj().obj, replace=False)
+            return self
+        return cls.from_obj(deepcopy(obj))
+
+    def desired_hash(self):
+        """
+        md5 of the desired state, excluding the desired-hash annotation itself
+        """
+        data = self.dict(by_alias=True, exclude_none=True)
+        data["metadata"]["annotations"].pop(DESIRED_HASH_ANNOTATION, None)
+        return hashlib.md5(
+            json.dumps(data, sort_keys=True, default=str).encode()
+        ).hexdigest()
+
+    def _applied_key(self):
+        return (self.apiVersion, self.kind, self.metadata.namespace, self.metadata.name)
+
+    def _stamp_desired_hash(self) -> Optional[bool]:
+        """
+        Stamp the desired-hash annotation, returns True when this process has
+        recently written the same desired state, False when it wrote another one
+        and None when it has no fresh record, so the cluster has to be asked
+        """
+        desired = self.desired_hash()
+        self.metadata.annotations[DESIRED_HASH_ANNOTATION] = desired
+        record = applied_hashes.get(self._applied_key())
+        if record is None or time.monotonic() - record[1] > APPLIED_HASH_TTL:
+            return None
+        return record[0] == desired
+
+    def _is_applied(self, current: Optional[Mapping]) -> bool:
+        """
+        Whether the object in the cluster carries the stamped desired hash and
+        still holds the desired fields, a child edited out of band keeps the
+        annotation
+        """
+        if current is None:
+            return False
+        annotations = current.get("metadata", {}).get("annotations") or {}
+        if (
+            annotations.get(DESIRED_HASH_ANNOTATION)
+            != self.metadata.annotations[DESIRED_HASH_ANNOTATION]
+        ):
+            return False
+        desired = self._applied_obj()
+        desired.pop("status", None)
+        if not contains(current, desired):
+            return False
+        self._mark_applied()
+        return True
+
+    def _mark_applied(self):
+        applied_hashes[self._applied_key()] = (
+            self.metadata.annotations[DESIRED_HASH_ANNOTATION],
+            time.monotonic(),
+        )
+
+    def _current(self) -> Optional[dict]:
+        obj = (
+            self._get_pykube_type()
+            .objects(kubeApi.get(), namespace=self.metadata.namespace)
+            .get_or_none(name=self.metadata.name)
+        )
+        return None if obj is None else obj.obj
+
+    def _applied_obj(self) -> dict:
+        self._sync()
+        data = fix_defaults(deepcopy(self._get_pykube_obj().obj))
+        # empty metadata fields would claim ownership of e.g. finalizers set by others
+        for key, value in list(data["metadata"].items()):
+            if value in ({}, []):
+                del data["metadata"][key]
+        return data
+
+    def _apply_kwargs(self, force: bool):
+        return self._get_pykube_obj().api_kwargs(
+            headers={"Content-Type": "application/apply-patch+yaml"},
+            params={"fieldManager": FIELD_MANAGER, "force": str(force).lower()},
+            data=json.dumps(self._applied_obj()),
+        )
+
+    def _upgrade_kwargs(self, current: Optional[Mapping]):
+        """
+        Request moving the fields of legacy managers to the operator, None when
+        there are none
+        """
+        if current is None:
+            return None
+        metadata = current["metadata"]
+        managedFields = upgrade_managed_fields(metadata.get("managedFields") or [])
+        if managedFields is None:
+            return None
+        patch = [
+            # fails instead of overwriting ownership changed meanwhile
+            {
+                "op": "test",
+                "path": "/metadata/resourceVersion",
+                "value": metadata["resourceVersion"],
+            },
+            {
+                "op": "replace",
+                "path": "/metadata/managedFields",
+                "value": managedFields,
+            },
+        ]
+        return self._get_pykube_obj().api_kwargs(
+            headers={"Content-Type": "application/json-patch+json"},
+            data=json.dumps(patch),
+        )
+
     def upsert(self):
-        if self.exists():
+        applied = self._stamp_desired_hash()
+        if applied:
+            return
+        current = self._current()
+        if applied is None and self._is_applied(current):
+            return
+        if current is not None:
             self.update()
         else:
             self.create()
+        self._mark_applied()
+
+    def apply(self, force=True):
+        """
+        Create or update the Kubernetes resource with a single server-side apply request
+        See https://kubernetes.io/docs/reference/using-api/server-side-apply/
+        """
+        applied = self._stamp_desired_hash()
+        if applied:
+            return
+        # only read the current object when this process does not know what it
+        # last wrote, a known change goes out as the one apply request
+        obj = self._get_pykube_obj()
+        if applied is None:
+            current = self._current()
+            if self._is_applied(current):
+                return
+            upgrade = self._upgrade_kwargs(current)
+            if upgrade is not None:
+                obj.api.raise_for_status(obj.api.patch(**upgrade))
+        r = obj.api.patch(**self._apply_kwargs(force))
+        obj.api.raise_for_status(r)
+        obj.set_obj(r.json())
+        self._mark_applied()
 
     def exists(self, ensure=False):
         # todo: merge logic
@@ -433,6 +726,119 @@ class Resource(BaseModel):
         data["kind"] = self.kind
         self._get_pykube_obj().set_obj(data)
 
+    @classmethod
+    async def _get_pykube_type_async(cls):
+        """
+        Resolve the pykube type in a thread on first use, API discovery is blocking
+        """
+        if (cls.apiVersion, cls.kind) not in object_factory:
+            await asyncio.get_running_loop().run_in_executor(None, cls._get_pykube_type)
+        return cls._get_pykube_type()
+
+    async def _get_pykube_obj_async(self):
+        await self._get_pykube_type_async()
+        return self._get_pykube_obj()
+
+    @classmethod
+    async def get_async(cls, name, namespace=None):
+        obj: APIObject = (await cls._get_pykube_type_async())(
+            kubeApi.get(), {"metadata": {"name": name, "namespace": namespace}}
+        )
+        r = await asyncKubeApi.get().get(**obj.api_kwargs())
+        if r.status == 404:
+            raise ObjectDoesNotExist(f"{name} does not exist.")
+        r.raise_for_status()
+        obj.set_obj(r.json())
+        return cls.from_pykube(obj)
+
+    async def _current_async(self) -> Optional[dict]:
+        obj = await self._get_pykube_obj_async()
+        r = await asyncKubeApi.get().get(**obj.api_kwargs())
+        if r.status == 404:
+            return None
+        r.raise_for_status()
+        return r.json()
+
+    async def create_async(self):
+        obj = await self._get_pykube_obj_async()
+        self._sync()
+        r = await asyncKubeApi.get().post(
+            **obj.api_kwargs(data=json.dumps(obj.obj), obj_list=True)
+        )
+        r.raise_for_status()
+        obj.set_obj(r.json())
+
+    async def reload_async(self):
+        obj = await self._get_pykube_obj_async()
+        r = await asyncKubeApi.get().get(**obj.api_kwargs())
+        r.raise_for_status()
+        obj.set_obj(r.json())
+        self._sync(True)
+
+    async def _merge_patch_async(self, obj: APIObject, patch, subresource=None):
+        r = await asyncKubeApi.get().patch(
+            **obj.api_kwargs(
+                subresource=subresource,
+                headers={"Content-Type": "application/merge-patch+json"},
+                data=json.dumps(patch),
+            )
+        )
+        r.raise_for_status()
+        obj.set_obj(r.json())
+
+    async def patch_async(self, strategic_merge_patch, *, subresource=None):
+        obj = await self._get_pykube_obj_async()
+        self._sync()
+        await self._merge_patch_async(obj, strategic_merge_patch, subresource)
+        self._sync(True)
+
+    async def update_async(self, is_strategic=True, *, subresource=None):
+        obj = await self._get_pykube_obj_async()
+        self._sync()
+        obj.obj = obj_merge(obj.obj, obj._original_obj, is_strategic)
+        await self._merge_patch_async(obj, obj.obj, subresource)
+        self._sync(True)
+
+    async def upsert_async(self):
+        applied = self._stamp_desired_hash()
+        if applied:
+            return
+        current = await self._current_async()
+        if applied is None and self._is_applied(current):
+            return
+        if current is not None:
+            await self.update_async()
+        else:
+            await self.create_async()
+        self._mark_applied()
+
+    async def apply_async(self, force=True):
+        applied = self._stamp_desired_hash()
+        if applied:
+            return
+        obj = await self._get_pykube_obj_async()
+        if applied is None:
+            current = await self._current_async()
+            if self._is_applied(current):
+                return
+            upgrade = self._upgrade_kwargs(current)
+            if upgrade is not None:
+                (await asyncKubeApi.get().patch(**upgrade)).raise_for_status()
+        r = await asyncKubeApi.get().patch(**self._apply_kwargs(force))
+        r.raise_for_status()
+        obj.set_obj(r.json())
+        self._mark_applied()
+
+    async def delete_async(self, propagation_policy: Optional[str] = None):
+        obj = await self._get_pykube_obj_async()
+        self._sync(True)
+        options = (
+            {"propagationPolicy": propagation_policy} if propagation_policy else {}
+        )
+        r = await asyncKubeApi.get().delete(**obj.api_kwargs(data=json.dumps(options)))
+        if r.status != 404:
+            r.raise_for_status()
+
     def owner(self, controller=True, blockOwnerDeletion=True):
 
         return OwnerReference(
@@ -1,4 +1,6 @@
 import re
+import threading
+from typing import Dict, Iterable, Mapping, Optional, Set, Tuple, Type
 from pydantic import BaseModel
 from pydantic.fields import PrivateAttr
 import pykube
@@ -28,6 +30,113 @@ class SecretData(BaseModel):
         return self
 
 
+class SecretCache(object):
+    """
+    Decoded data of the Secrets referenced by FRPServers and FRPClients, fed by a
+    watch. Only referenced secrets are kept, so a change to one of them can be
+    traced back to the objects whose config has to be re-rendered.
+    """
+
+    def __init__(self):
+        self.data: Dict[Tuple[Optional[str], str], Dict[str, str]] = {}
+        self.references: Dict[Tuple, Set[Tuple[Optional[str], str]]] = {}
+        self.referencedBy: Dict[Tuple[Optional[str], str], Set[Tuple]] = {}
+        # referrer -> metadata.generation its references were read from
+        self.generations: Dict[Tuple, Optional[int]] = {}
+        self.lock = threading.Lock()
+
+    def reference(
+        self, referrer: Tuple, namespace: Optional[str], names: Iterable[str]
+    ):
+        keys = {(namespace, name) for name in names}
+        with self.lock:
+            previous = self.references.get(referrer, set())
+            self.references[referrer] = keys
+            self._move(referrer, previous, keys)
+
+    def unreference(self, referrer: Tuple):
+        with self.lock:
+            self.generations.pop(referrer, None)
+            self._move(referrer, self.references.pop(referrer, set()), set())
+
+    def referenceBy(self, resource: Type[Resource], event: Mapping):
+        """
+        Follow the secret references of a raw event of an FRPServer or FRPClient.
+        Events of an unchanged generation (status, annotations) are skipped
+        """
+        metadata = event["object"]["metadata"]
+        referrer = (resource.kind, metadata["namespace"], metadata["name"])
+        if event["type"] == "DELETED":
+            self.unreference(referrer)
+            return
+        generation = metadata.get("generation")
+        if generation is not None and self.generations.get(referrer) == generation:
+            return
+        self.reference(
+            referrer,
+            metadata["namespace"],
+            resource.parse_obj(event["object"]).spec.secretNames(),
+        )
+        self.generations[referrer] = generation
+
+    def _move(self, referrer: Tuple, previous: Set, keys: Set):
+        """
+        Update referencedBy for the keys referrer no longer and newly references,
+        data of secrets nobody references anymore is dropped
+        """
+        for key in keys - previous:
+            self.referencedBy.setdefault(key, set()).add(referrer)
+        for key in previous - keys:
+            referrers = self.referencedBy.get(key, set())
+            referrers.discard(referrer)
+            if not referrers:
+                self.referencedBy.pop(key, None)
+                self.data.pop(key, None)
+
+    def isReferenced(self, namespace: Optional[str], name: str):
+        return (namespace, name) in self.referencedBy
+
+    def referrers(self, namespace: Optional[str], name: str):
+        with self.lock:
+            return list(self.referencedBy.get((namespace, name), ()))
+
+    def get(self, namespace: Optional[str], name: str) -> Optional[Dict[str, str]]:
+        return self.data.get((namespace, name))
+
+    def put(self, obj: Mapping) -> bool:
+        """
+        Store decoded data of a raw Secret if it is referenced, returns True when
+        previously cached data changed
+        """
+        key = (obj["metadata"].get("namespace"), obj["metadata"]["name"])
+        if not self.isReferenced(*key):
+            return False
+        decoded = {
+            k: b64decode(v.encode()).decode()
+            for k, v in (obj.get("data") or {}).items()
+        }
+        with self.lock:
+            previous = self.data.get(key)
+            self.data[key] = decoded
+        return previous is not None and previous != decoded
+
+    def apply(self, event: Mapping) -> bool:
+        """
+        Apply a raw watch event, returns True when a referenced secret was rotated
+        """
+        obj = event["object"]
+        if event.get("type") == "DELETED":
+            with self.lock:
+                self.data.pop(
+                    (obj["metadata"].get("namespace"), obj["metadata"]["name"]), None
+                )
+            return False
+        return self.put(obj)
+
+
+secret_cache = SecretCache()
+
+
 class BasicAuthSecretData(SecretData):
     username: str
     password: str
@@ -67,8 +176,22 @@ class Secret(Resource, group="", version="v1"):
         return self
 
     @classmethod
-    def from_pykube(cls, obj):
-        self = super().from_pykube(obj)
+    def get_cached(cls, name, namespace=None):
+        """
+        Get secret with decoded data from secret_cache, falls back to get() on miss
+        """
+        data = secret_cache.get(namespace, name)
+        if data is None:
+            self = cls.get(name, namespace)
+            secret_cache.put(self._get_pykube_obj().obj)
+            return self
+        return cls.parse_obj(
+            {"metadata": {"name": name, "namespace": namespace}, "data": data}
+        )
+
+    @classmethod
+    def from_obj(cls, obj):
+        self = super().from_obj(obj)
         self.data._decoded = False
         return self
 
@@ -0,0 +1,243 @@
+import hashlib
+import json
+import threading
+import typing
+
+from index import EndpointIndex, LabelIndex, matchLabelsBySelector
+from resources.FRPClient import FRPClient
+from resources.FRPClientEndpoint import FRPClientEndpointModel
+from resources.Namespace import Namespace
+from resources.common import Labels
+from metrics import RENDER_DURATION
+from compression import compress
+
+
+def configVersion(config: str):
+    return hashlib.md5(config.encode()).hexdigest()
+
+
+Proxies = typing.Dict[str, typing.Dict[str, str]]
+
+
+class RenderedServices(object):
+    """Services config of one selection together with what it was selected from"""
+
+    def __init__(
+        self,
+        selection: "SelectionKey",
+        selector: Labels,
+        namespaceSelector: typing.Optional[Labels],
+        namespaces: typing.FrozenSet[str],
+        keys: typing.FrozenSet[typing.Tuple[str, str]],
+        proxies: Proxies,
+    ):
+        self.selection = selection
+        self.selector = selector
+        self.namespaceSelector = namespaceSelector
+        self.namespaces = namespaces
+        self.keys = keys
+        self.proxies = proxies
+        self.config = "\n".join(proxy["config"] for proxy in proxies.values())
+        self.version = configVersion(self.config)
+        self.body = json.dumps(
+            {"config": self.config, "version": self.version}
+        ).encode()
+        # (format, content encoding) -> body, built on first request
+        self._encoded: typing.Dict[typing.Tuple[str, typing.Optional[str]], bytes] = {
+            ("config", None): self.body
+        }
+
+    def encode(self, format: str = "config", encoding: typing.Optional[str] = None):
+        """
+        Response body: the joined config, or with format "proxies" every proxy
+        section by name with its hash so clients can diff sections. Compressed
+        bodies are kept, so each generation is compressed once per encoding.
+        """
+        if format != "proxies":
+            format = "config"
+        body = self._encoded.get((format, encoding))
+        if body is not None:
+            return body
+        if encoding is not None:
+            body = compress(self.encode(format), encoding, level=9)
+        else:
+            body = json.dumps(
+                {"proxies": self.proxies, "version": self.version}
+            ).encode()
+        self._encoded[(format, encoding)] = body
+        return body
+
+    def selects(self, namespace: str, labels: Labels):
+        return namespace in self.namespaces and matchLabelsBySelector(
+            self.selector, labels
+        )
+
+
+# (own namespace or None, selector, namespaceSelector) with sorted label items
+SelectionKey = typing.Tuple[
+    typing.Optional[str],
+    typing.Tuple[typing.Tuple[str, str], ...],
+    typing.Optional[typing.Tuple[typing.Tuple[str, str], ...]],
+]
+
+
+def selectionKey(client: FRPClient) -> SelectionKey:
+    """
+    Canonical form of what a FRPClient selects, equal for all clients whose
+    selectors select the same endpoints
+    """
+    namespaceSelector = client.spec.namespaceSelector
+    return (
+        client.metadata.namespace if namespaceSelector is None else None,
+        tuple(sorted(client.spec.selector.items())),
+        None if namespaceSelector is None else tuple(sorted(namespaceSelector.items())),
+    )
+
+
+class ServicesConfigCache(object):
+    """
+    Materialized services config per distinct selection (see selectionKey), built
+    from per-endpoint rendered fragments and shared by all FRPClients selecting
+    alike. Owns updates of the endpoint and namespace indexes so it can drop
+    exactly the entries an endpoint or namespace change affects; updates return
+    the selections they invalidated.
+    """
+
+    def __init__(
+        self,
+        endpoints: EndpointIndex[FRPClientEndpointModel],
+        namespaces: LabelIndex[str, Namespace],
+    ):
+        self.endpoints = endpoints
+        self.namespaces = namespaces
+        self.fragments: typing.Dict[typing.Tuple[str, str], str] = {}
+        self.hashes: typing.Dict[typing.Tuple[str, str], str] = {}
+        self.rendered: typing.Dict[SelectionKey, RenderedServices] = {}
+        # FRPClient -> its selection, to drop selections no client uses anymore
+        self.clients: typing.Dict[typing.Tuple[str, str], SelectionKey] = {}
+        self.lock = threading.RLock()
+
+    def putEndpoint(self, endpoint: FRPClientEndpointModel):
+        assert endpoint.metadata.namespace
+        key = (endpoint.metadata.namespace, endpoint.metadata.name)
+        # render before touching the index, so an endpoint failing to render
+        # never ends up selected without a fragment
+        fragment = endpoint.config()
+        with self.lock:
+            self.endpoints.put(key, endpoint, endpoint.metadata.labels)
+            self.fragments[key] = fragment
+            self.hashes[key] = configVersion(fragment)
+            return self._invalidateEndpoint(key, endpoint.metadata.labels)
+
+    def popEndpoint(self, namespace: str, name: str):
+        key = (namespace, name)
+        with self.lock:
+            self.endpoints.pop(key)
+            self.fragments.pop(key, None)
+            self.hashes.pop(key, None)
+            return self._invalidateEndpoint(key, None)
+
+    def putNamespace(self, namespace: Namespace):
+        name = namespace.metadata.name
+        with self.lock:
+            old = self.namespaces.labels.get(name)
+            self.namespaces.put(name, namespace, namespace.metadata.labels)
+            return self._invalidateNamespace(old, namespace.metadata.labels)
+
+    def popNamespace(self, name: str):
+        with self.lock:
+            old = self.namespaces.labels.get(name)
+            self.namespaces.pop(name)
+            return self._invalidateNamespace(old, None)
+
+    def forget(self, namespace: str, name: str):
+        with self.lock:
+            self._release(self.clients.pop((namespace, name), None))
+
+    def _release(self, selection: typing.Optional[SelectionKey]):
+        if selection is not None and selection not in self.clients.values():
+            self.rendered.pop(selection, None)
+
+    def isCurrent(self, entry: RenderedServices):
+        """
+        Whether entry was not invalidated since it was rendered
+        """
+        return self.rendered.get(entry.selection) is entry
+
+    def get(self, client: FRPClient) -> RenderedServices:
+        assert client.metadata.namespace
+        key = (client.metadata.namespace, client.metadata.name)
+        selection = selectionKey(client)
+        with self.lock:
+            previous = self.clients.get(key)
+            if previous != selection:
+                self.clients[key] = selection
+                self._release(previous)
+
+            entry = self.rendered.get(selection)
+            if entry is not None:
+                return entry
+
+            with RENDER_DURATION.labels("services").time():
+                entry = self.rendered[selection] = self._render(client, selection)
+            return entry
+
+    def _render(self, client: FRPClient, selection: SelectionKey):
+        assert client.metadata.namespace
+        if client.spec.namespaceSelector is None:
+            selectedNamespaces = frozenset([client.metadata.namespace])
+        else:
+            selectedNamespaces = frozenset(
+                self.namespaces.select(client.spec.namespaceSelector)
+            )
+        keys = frozenset(
+            self.endpoints.select(client.spec.selector, selectedNamespaces)
+        )
+        return RenderedServices(
+            selection=selection,
+            selector=dict(client.spec.selector),
+            namespaceSelector=(
+                None
+                if client.spec.namespaceSelector is None
+                else dict(client.spec.namespaceSelector)
+            ),
+            namespaces=selectedNamespaces,
+            keys=keys,
+            proxies={
+                f"{namespace}_{name}": {
+                    "config": self.fragments[(namespace, name)],
+                    "hash": self.hashes[(namespace, name)],
+                }
+                for namespace, name in sorted(keys)
+            },
+        )
+
+    def _invalidateEndpoint(
+        self, key: typing.Tuple[str, str], labels: typing.Optional[Labels]
+    ) -> typing.Set[SelectionKey]:
+        invalidated = set()
+        for selection, entry in list(self.rendered.items()):
+            if key in entry.keys or (
+                labels is not None and entry.selects(key[0], labels)
+            ):
+                del self.rendered[selection]
+                invalidated.add(selection)
+        return invalidated
+
+    def _invalidateNamespace(
+        self, old: typing.Optional[Labels], new: typing.Optional[Labels]
+    ) -> typing.Set[SelectionKey]:
+        invalidated = set()
+        for selection, entry in list(self.rendered.items()):
+            if entry.namespaceSelector is None:
+                continue
+            wasSelected = old is not None and matchLabelsBySelector(
+                entry.namespaceSelector, old
+            )
+            isSelected = new is not None and matchLabelsBySelector(
+                entry.namespaceSelector, new
+            )
+            if wasSelected != isSelected:
+                del self.rendered[selection]
+                invalidated.add(selection)
+        return invalidated
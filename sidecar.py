@@ -1,40 +1,235 @@
 from os import getenv
 import requests
 import base64
+import logging
 import time
 
-with open("/config/default/frpc.ini") as f:
-    defaultConfig = f.read()
-parsedConfig = defaultConfig.split("\n")
-
-token = parsedConfig[1].removeprefix("token = ")
-port = parsedConfig[5].removeprefix("admin_port = ")
-user = parsedConfig[6].removeprefix("admin_user = ")
-password = parsedConfig[7].removeprefix("admin_pwd = ")
-
-prevConfig = defaultConfig
-
-def updateConfig(config: str):
-    with open("/config/frp/frpc.ini", "w") as f:
-        f.write(config)
-    auth = base64.b64encode(f"{user}:{password}".encode()).decode()
-    requests.put(
-        f"http://localhost:{int(port)}/api/config",
-        headers={"Authorization": f"Basic {auth}"},
-        data=config,
-    )
-    requests.get(
-        f"http://localhost:{int(port)}/api/reload",
-        headers={"Authorization": f"Basic {auth}"},
+logger = logging.getLogger("sidecar")
+
+API = getenv("API_URL", "http://api.frp-operator")
+watchTimeout = int(getenv("WATCH_TIMEOUT", 60))
+# changes arriving within this window after the first one share one reload
+batchSeconds = float(getenv("BATCH_SECONDS", 2))
+# frpc admin api requests, a hung frpc must not stall the other clients
+adminTimeout = float(getenv("ADMIN_TIMEOUT", 10))
+# long-poll timeout while a failed reload waits to be retried
+retrySeconds = float(getenv("RETRY_SECONDS", 5))
+
+
+class Client(object):
+    """
+    One frpc instance: its default config, admin api and the proxies it runs
+    """
+
+    def __init__(self, namespace: str, name: str, configDir: str, adminUrl: str):
+        self.namespace = namespace
+        self.name = name
+        self.configDir = configDir
+        self.adminUrl = adminUrl
+        with open(f"{configDir}/default/frpc.ini") as f:
+            self.defaultConfig = f.read()
+        parsedConfig = self.defaultConfig.split("\n")
+        user = parsedConfig[6].removeprefix("admin_user = ")
+        password = parsedConfig[7].removeprefix("admin_pwd = ")
+        self.auth = base64.b64encode(f"{user}:{password}".encode()).decode()
+        self.version = None
+        # proxy section name -> hash of the section frpc is running with
+        self.applied = None
+        # proxies whose reload failed, retried with the next poll
+        self.pending = None
+
+    def updateConfig(self, config: str):
+        with open(f"{self.configDir}/frp/frpc.ini", "w") as f:
+            f.write(config)
+        requests.put(
+            f"{self.adminUrl}/api/config",
+            headers={"Authorization": f"Basic {self.auth}"},
+            data=config,
+            timeout=adminTimeout,
+        ).raise_for_status()
+        requests.get(
+            f"{self.adminUrl}/api/reload",
+            headers={"Authorization": f"Basic {self.auth}"},
+            timeout=adminTimeout,
+        ).raise_for_status()
+
+    def delta(self, proxies: dict):
+        hashes = {name: proxy["hash"] for name, proxy in proxies.items()}
+        applied = self.applied or {}
+        added = hashes.keys() - applied.keys()
+        removed = applied.keys() - hashes.keys()
+        changed = {
+            name
+            for name in hashes.keys() & applied.keys()
+            if hashes[name] != applied[name]
+        }
+        return added, removed, changed
+
+    def applyProxies(self, proxies: dict):
+        """
+        Reload frpc with proxies unless it runs them already. applied is only
+        recorded once frpc took the config, a failed reload stays pending
+        """
+        if self.applied is not None:
+            added, removed, changed = self.delta(proxies)
+            if not (added or removed or changed):
+                self.pending = None
+                return
+            logger.info(
+                "Reloading %s/%s: %d added, %d removed, %d changed proxies",
+                self.namespace,
+                self.name,
+                len(added),
+                len(removed),
+                len(changed),
+            )
+        # frpc's admin api only takes whole configs, sections are kept in name
+        # order so unchanged proxies stay where they were
+        cfg = f"{self.defaultConfig}\n\n"
+        cfg += "\n".join(proxies[name]["config"] for name in sorted(proxies))
+        try:
+            self.updateConfig(cfg)
+        except (OSError, requests.RequestException) as e:
+            logger.warning("Reloading %s/%s failed: %s", self.namespace, self.name, e)
+            self.pending = proxies
+            return
+        self.pending = None
+        self.applied = {name: proxy["hash"] for name, proxy in proxies.items()}
+
+    def fetchProxies(self, timeout: float):
+        """
+        Long-poll the apiserver for the proxies of this client, None if unchanged
+        """
+        # requests decodes gzip bodies transparently
+        headers = {"Accept-Encoding": "gzip"}
+        if self.version:
+            headers["If-None-Match"] = f'"{self.version}"'
+        response = requests.get(
+            f"{API}/frpc/{self.namespace}/{self.name}/config/services/watch",
+            params={"timeout": timeout, "format": "proxies"},
+            headers=headers,
+            timeout=timeout + 10,
+        )
+        response.raise_for_status()
+        if response.status_code == 304:
+            return None
+        services = response.json()
+        self.version = services["version"]
+        return services["proxies"]
+
+
+def fetchBatch(clients: dict, timeout: float):
+    """
+    Long-poll the apiserver for the proxies of all clients in one request,
+    returns the changed ones by (namespace, name)
+    """
+    response = requests.post(
+        f"{API}/frpc/config/services",
+        params={"timeout": timeout},
+        headers={"Accept-Encoding": "gzip"},
+        json={
+            "format": "proxies",
+            "clients": [
+                {"namespace": c.namespace, "name": c.name, "version": c.version}
+                for c in clients.values()
+            ],
+        },
+        timeout=timeout + 10,
     )
+    response.raise_for_status()
+    result = response.json()
+    for missing in result["missing"]:
+        logger.warning(
+            "FRPClient %s/%s not found", missing["namespace"], missing["name"]
+        )
+    changed = {}
+    for item in result["changed"]:
+        key = (item["namespace"], item["name"])
+        clients[key].version = item["services"]["version"]
+        changed[key] = item["services"]["proxies"]
+    return changed
+
+
+def fetchOne(clients: dict, timeout: float):
+    ((key, client),) = clients.items()
+    proxies = client.fetchProxies(timeout)
+    return {} if proxies is None else {key: proxies}
+
+
+def poll(clients: dict, fetch):
+    """
+    Long-poll with fetch(clients, timeout) and apply what changed, changes
+    arriving within batchSeconds after the first one are applied together.
+    Failed reloads are retried every retrySeconds, newer proxies replace them
+    """
+    while True:
+        pending = {
+            key: client.pending
+            for key, client in clients.items()
+            if client.pending is not None
+        }
+        try:
+            changed = fetch(clients, retrySeconds if pending else watchTimeout)
+        except requests.HTTPError as e:
+            # 503 while the apiserver is still syncing
+            time.sleep(int(e.response.headers.get("Retry-After", 5)))
+            continue
+        except requests.RequestException:
+            time.sleep(5)
+            continue
+        changed = {**pending, **changed}
+        if not changed:
+            continue
+        if all(clients[key].applied is not None for key in changed):
+            deadline = time.monotonic() + batchSeconds
+            while (remaining := deadline - time.monotonic()) > 0:
+                try:
+                    changed.update(fetch(clients, remaining))
+                except requests.RequestException:
+                    break
+        for key, proxies in changed.items():
+            clients[key].applyProxies(proxies)
 
 
-while True:
-    time.sleep(5)
-    cfg = f"{defaultConfig}\n\n"
-    cfg += requests.get(
-        f"http://api.frp-operator/frpc/{getenv('NAMESPACE')}/{getenv('NAME')}/config/services"
-    ).json()["config"]
-    if cfg != prevConfig:
-        updateConfig(cfg)
-    prevConfig = cfg
+def podClients():
+    """
+    Sidecar of a single frpc pod, configured by the operator
+    """
+    with open("/config/default/frpc.ini") as f:
+        port = f.read().split("\n")[5].removeprefix("admin_port = ")
+    namespace, name = getenv("NAMESPACE"), getenv("NAME")
+    return {
+        (namespace, name): Client(
+            namespace, name, "/config", f"http://localhost:{int(port)}"
+        )
+    }
+
+
+def agentClients():
+    """
+    Node agent mode: AGENT_CLIENTS lists one "namespace/name admin-url" per
+    line, each with its config directory at AGENT_ROOT/namespace/name
+    """
+    root = getenv("AGENT_ROOT", "/config")
+    clients = {}
+    for line in getenv("AGENT_CLIENTS", "").splitlines():
+        if not line.strip():
+            continue
+        target, adminUrl = line.split()
+        namespace, name = target.split("/")
+        clients[(namespace, name)] = Client(
+            namespace, name, f"{root}/{namespace}/{name}", adminUrl
+        )
+    return clients
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
+    if getenv("AGENT_CLIENTS"):
+        # one request per interval for all frpc instances of a node
+        poll(agentClients(), fetchBatch)
+    else:
+        poll(podClients(), fetchOne)
@@ -0,0 +1,280 @@
+import asyncio
+import base64
+import gzip
+import json
+import logging
+import os
+import socket
+import typing
+from datetime import datetime, timedelta, timezone
+
+import pykube
+from pykube.exceptions import HTTPError
+
+from informer import Informer
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FORMAT = 1
+# metadata the apiserver never reads, managedFields and kopf's bookkeeping
+# can be as large as the objects themselves
+DROPPED_ANNOTATIONS = (
+    "kopf.zalando.org/",
+    "frp.nonamestudio.me/",
+    "kubectl.kubernetes.io/last-applied-configuration",
+)
+MICRO_TIME = "%Y-%m-%dT%H:%M:%S.%fZ"
+
+
+def slim(obj: dict):
+    metadata = {
+        key: value for key, value in obj["metadata"].items() if key != "managedFields"
+    }
+    annotations = {
+        key: value
+        for key, value in (metadata.get("annotations") or {}).items()
+        if not key.startswith(DROPPED_ANNOTATIONS)
+    }
+    if annotations:
+        metadata["annotations"] = annotations
+    else:
+        metadata.pop("annotations", None)
+    return {**obj, "metadata": metadata}
+
+
+class FileStore(object):
+    """
+    Snapshot in a local file, only survives restarts on a persistent volume
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def __str__(self):
+        return self.path
+
+    def read(self) -> typing.Optional[bytes]:
+        try:
+            with open(self.path, "rb") as fp:
+                return fp.read()
+        except FileNotFoundError:
+            return None
+
+    def lead(self):
+        # every replica has a file of its own
+        return True
+
+    def write(self, payload: bytes):
+        temporary = f"{self.path}.{os.getpid()}.tmp"
+        with open(temporary, "wb") as fp:
+            fp.write(payload)
+        os.replace(temporary, self.path)
+
+
+class ConfigMapStore(object):
+    """
+    Snapshot in the binaryData of a ConfigMap, shared by all replicas and kept
+    across rollouts and rescheduling. Only the holder of the Lease of the same
+    name writes it, another replica takes over once the lease expired.
+    """
+
+    KEY = "snapshot.json.gz"
+    # ConfigMaps are limited to 1MiB
+    MAX_BYTES = 1000 * 1000
+
+    def __init__(
+        self,
+        api: pykube.HTTPClient,
+        namespace: str,
+        name: str,
+        leaseSeconds: float = 90,
+        identity: typing.Optional[str] = None,
+    ):
+        self.api = api
+        self.namespace = namespace
+        self.name = name
+        self.leaseSeconds = leaseSeconds
+        # the pod name
+        self.identity = identity or socket.gethostname()
+
+    def __str__(self):
+        return f"configmap {self.namespace}/{self.name}"
+
+    def _get(self):
+        return pykube.ConfigMap.objects(self.api, namespace=self.namespace).get_or_none(
+            name=self.name
+        )
+
+    def lead(self) -> bool:
+        """
+        Take or renew the lease, whether this replica holds it
+        """
+        Lease = pykube.object_factory(self.api, "coordination.k8s.io/v1", "Lease")
+        now = datetime.now(timezone.utc)
+        spec = {
+            "holderIdentity": self.identity,
+            "leaseDurationSeconds": int(self.leaseSeconds),
+            "renewTime": now.strftime(MICRO_TIME),
+        }
+        lease = Lease.objects(self.api, namespace=self.namespace).get_or_none(
+            name=self.name
+        )
+        try:
+            if lease is None:
+                Lease(
+                    self.api,
+                    {
+                        "apiVersion": "coordination.k8s.io/v1",
+                        "kind": "Lease",
+                        "metadata": {"name": self.name, "namespace": self.namespace},
+                        "spec": spec,
+                    },
+                ).create()
+                return True
+            current = lease.obj.get("spec") or {}
+            if current.get("holderIdentity") != self.identity:
+                renewed = datetime.strptime(
+                    current.get("renewTime") or "1970-01-01T00:00:00.000000Z",
+                    MICRO_TIME,
+                ).replace(tzinfo=timezone.utc)
+                duration = timedelta(seconds=current.get("leaseDurationSeconds", 0))
+                if renewed + duration > now:
+                    return False
+            lease.obj["spec"] = {**current, **spec}
+            # carries the resourceVersion, so only one replica takes it over
+            lease.update()
+        except HTTPError as e:
+            if e.code == 409:
+                return False
+            raise
+        return True
+
+    def read(self) -> typing.Optional[bytes]:
+        configMap = self._get()
+        if configMap is None:
+            return None
+        payload = (configMap.obj.get("binaryData") or {}).get(self.KEY)
+        return None if payload is None else base64.b64decode(payload)
+
+    def write(self, payload: bytes):
+        if len(payload) > self.MAX_BYTES:
+            logger.warning(
+                "Snapshot of %d bytes does not fit %s, not written", len(payload), self
+            )
+            return
+        binaryData = {self.KEY: base64.b64encode(payload).decode()}
+        configMap = self._get()
+        if configMap is None:
+            pykube.ConfigMap(
+                self.api,
+                {
+                    "apiVersion": "v1",
+                    "kind": "ConfigMap",
+                    "metadata": {"name": self.name, "namespace": self.namespace},
+                    "binaryData": binaryData,
+                },
+            ).create()
+        else:
+            configMap.obj["binaryData"] = binaryData
+            configMap.update()
+
+
+Store = typing.Union[FileStore, ConfigMapStore]
+
+
+class Snapshot(object):
+    """
+    Objects and resourceVersions of a set of informers, periodically written as
+    gzip compressed JSON to a store. Loading it at startup makes the state
+    complete right away and lets the informers resume watching instead of
+    relisting.
+    """
+
+    def __init__(
+        self, store: Store, informers: typing.List[Informer], interval: float = 30
+    ):
+        self.store = store
+        self.informers = informers
+        self.interval = interval
+        self.written: typing.Optional[typing.Tuple] = None
+        self.task: typing.Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _key(informer: Informer):
+        return f"{informer.resource.apiVersion}/{informer.resource.kind}"
+
+    def _changes(self):
+        return tuple(informer.changes for informer in self.informers)
+
+    def load(self):
+        try:
+            payload = self.store.read()
+            if payload is None:
+                return False
+            data = json.loads(gzip.decompress(payload))
+        except Exception:
+            logger.exception("Ignoring unreadable snapshot %s", self.store)
+            return False
+        if data.get("format") != SNAPSHOT_FORMAT:
+            return False
+        for informer in self.informers:
+            entry = data["informers"].get(self._key(informer))
+            if entry is not None:
+                informer.restore(entry["items"], entry["resourceVersion"])
+        self.written = self._changes()
+        return True
+
+    def collect(self):
+        """
+        Snapshot contents, taken on the event loop so informers don't change them
+        while they are serialized
+        """
+        return {
+            "format": SNAPSHOT_FORMAT,
+            "informers": {
+                self._key(informer): {
+                    "resourceVersion": informer.resourceVersion,
+                    "items": [slim(obj) for obj in informer.objects.values()],
+                }
+                for informer in self.informers
+                if informer.resourceVersion is not None
+            },
+        }
+
+    def write(self, data: dict):
+        payload = json.dumps(data, separators=(",", ":")).encode()
+        self.store.write(gzip.compress(payload, mtime=0))
+
+    async def dump(self):
+        """
+        Write the snapshot if an object changed since the last one and this
+        replica is the writer
+        """
+        changes = self._changes()
+        if changes == self.written:
+            return
+        loop = asyncio.get_running_loop()
+        if not await loop.run_in_executor(None, self.store.lead):
+            return
+        await loop.run_in_executor(None, self.write, self.collect())
+        self.written = changes
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.dump()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Writing snapshot %s failed", self.store)
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.run())
+        return self.task
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+        await self.dump()
@@ -0,0 +1,28 @@
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# bench/fakekube.py serves as the api server of tests that talk to one
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+
+# context.py builds its API clients at import, the tests never reach them
+if "KUBECONFIG" not in os.environ:
+    kubeconfig = tempfile.NamedTemporaryFile("w", suffix=".yaml", delete=False)
+    kubeconfig.write("""
+apiVersion: v1
+kind: Config
+clusters:
+  - name: test
+    cluster: {server: "http://127.0.0.1:1"}
+contexts:
+  - name: test
+    context: {cluster: test, user: test}
+current-context: test
+users:
+  - name: test
+    user: {token: test}
+""")
+    kubeconfig.close()
+    os.environ["KUBECONFIG"] = kubeconfig.name
@@ -0,0 +1,117 @@
+import asyncio
+import os
+import tempfile
+
+import pykube
+import pytest
+
+from asyncclient import AsyncHTTPClient
+from context import asyncKubeApi, kubeApi
+from resources import resource
+from resources.resource import ObjectMeta
+from resources.Service import Service, ServicePort, ServiceSpec
+from fakekube import FakeKube
+
+
+@pytest.fixture
+def kube():
+    kube = FakeKube()
+    kube.start()
+    kubeconfig = tempfile.NamedTemporaryFile("w", suffix=".yaml", delete=False)
+    kubeconfig.write(kube.kubeconfig())
+    kubeconfig.close()
+    api = pykube.HTTPClient(pykube.KubeConfig.from_file(kubeconfig.name))
+    tokens = kubeApi.set(api), asyncKubeApi.set(AsyncHTTPClient(api))
+    resource.applied_hashes.clear()
+    yield kube
+    kubeApi.reset(tokens[0])
+    asyncKubeApi.reset(tokens[1])
+    os.unlink(kubeconfig.name)
+
+
+def service(*ports: str):
+    numbers = {"http": 80, "https": 443, "dashboard": 7500}
+    return Service(
+        metadata=ObjectMeta(name="frps", namespace="default"),
+        spec=ServiceSpec(
+            selector={"app": "frps"},
+            ports=[
+                ServicePort(name=port, port=numbers[port], targetPort=port)
+                for port in ports
+            ],
+        ),
+    )
+
+
+def ports(kube: FakeKube):
+    obj = kube.collections[("v1", "services")].objects[("default", "frps")]
+    return [port["name"] for port in obj["spec"]["ports"]]
+
+
+def managers(kube: FakeKube):
+    obj = kube.collections[("v1", "services")].objects[("default", "frps")]
+    return {
+        (entry["manager"], entry["operation"])
+        for entry in obj["metadata"]["managedFields"]
+    }
+
+
+def test_apply_removes_dropped_port(kube):
+    service("http", "https").apply()
+    service("http").apply()
+    assert ports(kube) == ["http"]
+
+
+def test_apply_after_legacy_update_removes_dropped_port(kube):
+    # children of releases before server-side apply were written by pykube
+    service("http", "https", "dashboard").create()
+    assert managers(kube) == {("pykube-ng", "Update")}
+
+    service("http", "https").apply()
+    assert managers(kube) == {("frp-operator", "Apply")}
+    service("http").apply()
+    assert ports(kube) == ["http"]
+
+
+def test_apply_async_after_legacy_update_removes_dropped_port(kube):
+    service("http", "https").create()
+
+    async def apply():
+        try:
+            await service("http").apply_async()
+        finally:
+            await asyncKubeApi.get().close()
+
+    asyncio.run(apply())
+    assert ports(kube) == ["http"]
+    assert managers(kube) == {("frp-operator", "Apply")}
+
+
+def test_legacy_manager_keeps_dropped_port_without_upgrade(kube, monkeypatch):
+    # what the upgrade prevents: the legacy manager keeps owning the port
+    monkeypatch.setattr(resource, "LEGACY_FIELD_MANAGERS", set())
+    service("http", "https").create()
+    service("http").apply()
+    assert ports(kube) == ["http", "https"]
+
+
+def test_apply_corrects_child_edited_out_of_band(kube):
+    service("http").apply()
+    edited = kube.collections[("v1", "services")].objects[("default", "frps")]
+    edited["spec"]["selector"] = {"app": "other"}
+    kube.put("v1", "services", edited)
+    # the edit keeps the desired-hash annotation, the record of this process expired
+    resource.applied_hashes.clear()
+
+    service("http").apply()
+    obj = kube.collections[("v1", "services")].objects[("default", "frps")]
+    assert obj["spec"]["selector"] == {"app": "frps"}
+
+
+def test_apply_skips_unchanged_child(kube):
+    service("http").apply()
+    version = kube.resourceVersion
+    resource.applied_hashes.clear()
+
+    service("http").apply()
+    assert kube.resourceVersion == version
@@ -0,0 +1,111 @@
+import logging
+
+import pytest
+
+from resources.FRPClient import FRPClient
+from resources.FRPClientEndpoint import FRPClientEndpointModel
+from resources.ini import IniConfig
+from resources.secret import secret_cache
+
+
+def endpoint(additionalConfig=""):
+    return FRPClientEndpointModel.parse_obj(
+        {
+            "metadata": {"name": "web", "namespace": "default"},
+            "spec": {
+                "type": "tcp",
+                "local": {"host": "web", "port": 8080},
+                "remote": {"port": 10000},
+                "additionalConfig": additionalConfig,
+            },
+        }
+    )
+
+
+def client(dashboard=None):
+    return FRPClient.parse_obj(
+        {
+            "metadata": {"name": "frpc", "namespace": "default"},
+            "spec": {
+                "target": {"host": "frps", "token": {"secret": "token"}},
+                "dashboard": dashboard,
+            },
+        }
+    )
+
+
+@pytest.fixture
+def secrets(monkeypatch):
+    monkeypatch.setitem(secret_cache.data, ("default", "token"), {"token": "t0k"})
+    monkeypatch.setitem(
+        secret_cache.data,
+        ("default", "dashboard"),
+        {"username": "admin", "password": "secret"},
+    )
+
+
+def test_common_first_then_sections_sorted():
+    config = IniConfig()
+    config.section("b").set("x", 1)
+    config.section("common").set("token", "t")
+    config.section("a").set("y", True)
+
+    assert config.render() == "[common]\ntoken = t\n\n[a]\ny = true\n\n[b]\nx = 1\n"
+
+
+def test_additional_config_overrides_generated_options():
+    config = IniConfig.parse(
+        endpoint("local_port = 9090\nuse_encryption = true").config()
+    )
+
+    options = config.section("default_web").options
+    assert options["local_port"] == "9090"
+    assert options["use_encryption"] == "true"
+    # overridden options keep their generated position
+    assert list(options)[:3] == ["type", "local_ip", "local_port"]
+
+
+def test_additional_config_extra_sections():
+    rendered = endpoint(
+        "bandwidth_limit = 1MB\n[default_web_2]\nlocal_port = 8081"
+    ).config()
+
+    config = IniConfig.parse(rendered)
+    assert [section.name for section in config.sections] == [
+        "default_web",
+        "default_web_2",
+    ]
+    assert config.section("default_web").options["bandwidth_limit"] == "1MB"
+    assert config.section("default_web_2").options == {"local_port": "8081"}
+
+
+def test_parse_skips_invalid_lines(caplog):
+    with caplog.at_level(logging.WARNING, logger="resources.ini"):
+        config = IniConfig.parse(
+            "orphan = 1\n[a]\n# comment\n; comment\nnot an option\n = 2\nx = 1",
+        )
+
+    assert config.render() == "[a]\nx = 1\n"
+    assert [record.getMessage() for record in caplog.records] == [
+        "Skipping invalid ini line: orphan = 1",
+        "Skipping invalid ini line: not an option",
+        "Skipping invalid ini line: = 2",
+    ]
+
+
+@pytest.mark.parametrize(
+    "dashboard, admin",
+    [
+        (None, ("7400", "sidecar", "pwd")),
+        ({"credentials": "dashboard", "port": 7500}, ("7500", "admin", "secret")),
+    ],
+)
+def test_client_common_line_positions(secrets, dashboard, admin):
+    # the sidecar reads these options by line number of the rendered [common]
+    lines = client(dashboard).config().split("\n")
+
+    assert lines[0] == "[common]"
+    assert lines[1] == "token = t0k"
+    assert lines[5] == f"admin_port = {admin[0]}"
+    assert lines[6] == f"admin_user = {admin[1]}"
+    assert lines[7] == f"admin_pwd = {admin[2]}"
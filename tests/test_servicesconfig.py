@@ -0,0 +1,166 @@
+import pytest
+
+from index import EndpointIndex, LabelIndex
+from resources.FRPClient import FRPClient
+from resources.FRPClientEndpoint import FRPClientEndpointModel
+from resources.Namespace import Namespace
+from servicesconfig import ServicesConfigCache, selectionKey
+
+
+def client(namespace, name, selector, namespaceSelector=None):
+    return FRPClient.parse_obj(
+        {
+            "metadata": {"name": name, "namespace": namespace},
+            "spec": {
+                "target": {"host": "frps", "token": {"secret": "token"}},
+                "selector": selector,
+                "namespaceSelector": namespaceSelector,
+            },
+        }
+    )
+
+
+def endpoint(namespace, name, labels, port=10000):
+    return FRPClientEndpointModel.parse_obj(
+        {
+            "metadata": {"name": name, "namespace": namespace, "labels": labels},
+            "spec": {
+                "type": "tcp",
+                "local": {"host": name, "port": 8080},
+                "remote": {"port": port},
+            },
+        }
+    )
+
+
+def namespace(name, labels):
+    return Namespace.parse_obj({"metadata": {"name": name, "labels": labels}})
+
+
+@pytest.fixture
+def services():
+    services = ServicesConfigCache(EndpointIndex(), LabelIndex())
+    for name, labels in [("a", {"frp": "true"}), ("b", {"frp": "true"}), ("c", {})]:
+        services.putNamespace(namespace(name, labels))
+    return services
+
+
+def test_endpoint_label_move(services):
+    one = client("a", "one", {"client": "one"})
+    two = client("a", "two", {"client": "two"})
+    services.putEndpoint(endpoint("a", "web", {"client": "one"}))
+    assert set(services.get(one).proxies) == {"a_web"}
+    assert services.get(two).proxies == {}
+
+    invalidated = services.putEndpoint(endpoint("a", "web", {"client": "two"}))
+    assert invalidated == {selectionKey(one), selectionKey(two)}
+    assert services.get(one).proxies == {}
+    assert set(services.get(two).proxies) == {"a_web"}
+
+
+def test_endpoint_change_keeps_unrelated_selections(services):
+    one = client("a", "one", {"client": "one"})
+    two = client("a", "two", {"client": "two"})
+    services.putEndpoint(endpoint("a", "web", {"client": "one"}))
+    services.get(one)
+    entry = services.get(two)
+
+    invalidated = services.putEndpoint(endpoint("a", "web", {"client": "one"}, 10001))
+    assert invalidated == {selectionKey(one)}
+    assert services.get(two) is entry
+
+
+def test_endpoint_removal(services):
+    one = client("a", "one", {"client": "one"})
+    services.putEndpoint(endpoint("a", "web", {"client": "one"}))
+    entry = services.get(one)
+
+    assert services.popEndpoint("a", "web") == {selectionKey(one)}
+    assert not services.isCurrent(entry)
+    assert services.get(one).proxies == {}
+
+
+def test_namespace_relabel(services):
+    wide = client("a", "wide", {"client": "one"}, {"frp": "true"})
+    local = client("c", "local", {"client": "one"})
+    services.putEndpoint(endpoint("a", "web", {"client": "one"}))
+    services.putEndpoint(endpoint("c", "db", {"client": "one"}))
+    assert set(services.get(wide).proxies) == {"a_web"}
+    assert set(services.get(local).proxies) == {"c_db"}
+
+    # namespaces without a namespaceSelector are not affected by labels
+    assert services.putNamespace(namespace("c", {"frp": "true"})) == {
+        selectionKey(wide)
+    }
+    assert set(services.get(wide).proxies) == {"a_web", "c_db"}
+
+    assert services.putNamespace(namespace("a", {})) == {selectionKey(wide)}
+    assert set(services.get(wide).proxies) == {"c_db"}
+
+    # labels that keep the selection as it is invalidate nothing
+    assert services.putNamespace(namespace("c", {"frp": "true", "x": "y"})) == set()
+
+
+def test_namespace_removal(services):
+    wide = client("a", "wide", {"client": "one"}, {"frp": "true"})
+    services.putEndpoint(endpoint("b", "web", {"client": "one"}))
+    assert set(services.get(wide).proxies) == {"b_web"}
+
+    assert services.popNamespace("b") == {selectionKey(wide)}
+    assert services.get(wide).proxies == {}
+
+
+def test_selector_change(services):
+    services.putEndpoint(endpoint("a", "web", {"client": "one"}))
+    services.putEndpoint(endpoint("a", "db", {"client": "two"}))
+    before = services.get(client("a", "c", {"client": "one"}))
+    assert set(before.proxies) == {"a_web"}
+
+    after = services.get(client("a", "c", {"client": "two"}))
+    assert set(after.proxies) == {"a_db"}
+    # the previous selection had no other client and was released
+    assert before.selection not in services.rendered
+    assert not services.isCurrent(before)
+
+
+def test_shared_selection(services):
+    services.putEndpoint(endpoint("a", "web", {"client": "one"}))
+    # selector item order does not matter
+    first = client("a", "first", {"client": "one", "tier": "web"})
+    second = client("a", "second", {"tier": "web", "client": "one"})
+    assert selectionKey(first) == selectionKey(second)
+    assert services.get(first) is services.get(second)
+
+    # the same selector in another namespace selects other endpoints
+    other = client("b", "first", {"client": "one", "tier": "web"})
+    assert selectionKey(other) != selectionKey(first)
+
+
+def test_shared_selection_release(services):
+    services.putEndpoint(endpoint("a", "web", {"client": "one"}))
+    first = client("a", "first", {"client": "one"})
+    second = client("a", "second", {"client": "one"})
+    entry = services.get(first)
+    assert services.get(second) is entry
+
+    services.forget("a", "first")
+    # still used by second
+    assert services.isCurrent(entry)
+
+    # second moving away releases the selection
+    services.get(client("a", "second", {"client": "two"}))
+    assert entry.selection not in services.rendered
+
+    services.get(first)
+    services.forget("a", "first")
+    assert entry.selection not in services.rendered
+
+
+def test_proxies_format_hashes(services):
+    one = client("a", "one", {"client": "one"})
+    services.putEndpoint(endpoint("a", "web", {"client": "one"}))
+    before = services.get(one).proxies["a_web"]["hash"]
+    services.putEndpoint(endpoint("a", "web", {"client": "one"}, 10001))
+    after = services.get(one).proxies["a_web"]
+    assert after["hash"] != before
+    assert "remote_port = 10001" in after["config"]
@@ -0,0 +1,98 @@
+import pytest
+import requests
+
+import sidecar
+
+DEFAULT_CONFIG = """[common]
+token = t0k
+server_addr = frps
+server_port = 7000
+admin_addr = 127.0.0.1
+admin_port = 7400
+admin_user = sidecar
+admin_pwd = pwd
+"""
+
+
+def proxy(name, hash):
+    return {"hash": hash, "config": f"[{name}]\nlocal_port = {hash}\n"}
+
+
+def proxies(**hashes):
+    return {name: proxy(name, hash) for name, hash in hashes.items()}
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    (tmp_path / "default").mkdir()
+    (tmp_path / "frp").mkdir()
+    (tmp_path / "default" / "frpc.ini").write_text(DEFAULT_CONFIG)
+    client = sidecar.Client("default", "frpc", str(tmp_path), "http://frpc:7400")
+    client.reloads = []
+    monkeypatch.setattr(client, "updateConfig", client.reloads.append)
+    return client
+
+
+def test_first_apply_reloads(client):
+    client.applyProxies(proxies(a="1", b="2"))
+
+    (config,) = client.reloads
+    assert config.startswith(DEFAULT_CONFIG)
+    assert config.index("[a]") < config.index("[b]")
+    assert client.applied == {"a": "1", "b": "2"}
+
+
+def test_first_apply_of_no_proxies_reloads(client):
+    client.applyProxies({})
+
+    assert len(client.reloads) == 1
+    assert client.applied == {}
+
+
+def test_delta(client):
+    client.applied = {"kept": "1", "changed": "2", "removed": "3"}
+
+    added, removed, changed = client.delta(proxies(kept="1", changed="4", added="5"))
+    assert added == {"added"}
+    assert removed == {"removed"}
+    assert changed == {"changed"}
+
+
+@pytest.mark.parametrize(
+    "update",
+    [
+        proxies(a="1", b="2", c="3"),
+        proxies(a="1"),
+        proxies(a="1", b="3"),
+    ],
+    ids=["add", "remove", "change"],
+)
+def test_delta_reloads(client, update):
+    client.applyProxies(proxies(a="1", b="2"))
+    client.applyProxies(update)
+
+    assert len(client.reloads) == 2
+    assert client.applied == {name: p["hash"] for name, p in update.items()}
+    assert all(p["config"] in client.reloads[1] for p in update.values())
+
+
+def test_reorder_does_not_reload(client):
+    client.applyProxies(proxies(a="1", b="2"))
+    client.applyProxies(dict(reversed(proxies(a="1", b="2").items())))
+
+    assert len(client.reloads) == 1
+
+
+def test_failed_reload_stays_pending(client, monkeypatch):
+    def fail(config):
+        raise requests.ConnectionError("frpc is down")
+
+    monkeypatch.setattr(client, "updateConfig", fail)
+    client.applyProxies(proxies(a="1"))
+    assert client.applied is None
+    assert client.pending == proxies(a="1")
+
+    monkeypatch.setattr(client, "updateConfig", client.reloads.append)
+    client.applyProxies(client.pending)
+    assert client.applied == {"a": "1"}
+    assert client.pending is None